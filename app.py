@@ -1,20 +1,19 @@
-from flask import Flask, render_template, abort, jsonify, redirect
-from jinja2 import Markup
+import json
+import os
+from flask import Flask, Response, render_template, abort, jsonify, redirect, request
 from db import App
+import config
 import web
-import markdown
 from tasks import TASKS, Site
+import jobs
+import metrics
 
 app = Flask(__name__)
 
-def markdown_to_html(md):
-    return Markup(markdown.markdown(md))
-
 @app.context_processor
 def app_context():
     return {
         "datestr": web.datestr,
-        "markdown_to_html": markdown_to_html,
     }
 
 @app.route("/")
@@ -24,6 +23,11 @@ def home():
     apps = [app for app in apps if app.name not in internal_users]
     return render_template("index.html", apps=apps)
 
+@app.route("/metrics")
+def metrics_page():
+    jobs.queue.update_metrics()
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/<name>")
 def app_page(name):
     app = App.find(name)
@@ -32,10 +36,27 @@ def app_page(name):
     if app.name != name:
         return redirect(f"/{app.name}")
 
-    site = Site(app.name)
-    status = site.get_status()
-    app.update_status(status)
-    return render_template("app.html", app=app, tasks=TASKS)
+    # the changelog is paged using the id of the last entry as the cursor
+    before = request.args.get("before", type=int)
+    changelog = app.get_changelog(limit=10, before=before)
+
+    return render_template("app.html",
+        app=app,
+        tasks=TASKS.tasks,
+        changelog=changelog,
+        job=jobs.queue.find_active(app.name),
+        is_stale=app.is_stale(config.STATUS_TTL))
+
+@app.route("/<name>/verify", methods=["POST"])
+def app_verify(name):
+    app = App.find(name)
+    if not app:
+        abort(404)
+
+    # the status is served from the db, re-verify only when it is stale
+    if app.is_stale(config.STATUS_TTL) and not jobs.queue.find_active(app.name):
+        jobs.queue.submit(app.name)
+    return redirect(f"/{app.name}")
 
 @app.route("/<name>/deploy", methods=["POST"])
 def app_deploy(name):
@@ -51,9 +72,50 @@ def app_deploy(name):
             "error": "deployment failed to sync",
             "message": sync_status.message
         }), 500
-    status = site.get_status()
-    app.update_status(status)
-    return jsonify(status)
+    job = jobs.queue.submit(app.name)
+    return jsonify(job.dict()), 202
+
+@app.route("/<name>/jobs/<job_id>")
+def app_job(name, job_id):
+    job = jobs.queue.get(job_id)
+    if not job or job.app_name.lower() != name.lower():
+        abort(404)
+
+    # ?wait=<seconds> waits for the job to finish, up to a minute
+    wait = request.args.get("wait", type=float)
+    if wait:
+        job.wait(timeout=min(wait, 60))
+    return jsonify(job.dict())
+
+@app.route("/<name>/jobs/<job_id>/events")
+def app_job_events(name, job_id):
+    """Streams the progress of the job as server-sent events, a check or
+    a task at a time, ending with a "done" or "failed" event.
+    """
+    job = jobs.queue.get(job_id)
+    if not job or job.app_name.lower() != name.lower():
+        abort(404)
+
+    # a reconnecting EventSource sends the id of the last event it got
+    last_id = request.headers.get("Last-Event-ID", type=int)
+    start = 0 if last_id is None else last_id + 1
+
+    def stream():
+        for item in job.iter_events(start):
+            if item is None:
+                yield ": keep-alive\n\n"
+                continue
+            i, event = item
+            yield f"id: {i}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+    return Response(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
 
 if __name__ == "__main__":
+    # the development server is a long running process, so it runs the jobs
+    # in its own threads unless the queue is set explicitly
+    if "RAJDHANI_JOB_QUEUE" not in os.environ:
+        jobs.queue = jobs.JobQueue(workers=config.WORKERS, max_jobs=config.MAX_JOBS)
     app.run(port=5050)
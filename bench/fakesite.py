@@ -0,0 +1,237 @@
+"""A stand-in for a participant's Rajdhani site, to benchmark the grader
+locally.
+
+The site answers every check in tasks.yml correctly: the responses are
+made from the expected values in the checks themselves. The latency of
+the responses and the failures can be injected to see how the grader
+behaves with slow or broken sites.
+
+Usage:
+
+    $ python -m bench.fakesite [--port 5050] [--latency MS] [--jitter MS] [--failure-rate P]
+
+The grader verifies it as Site("localhost"), which is at port 5050.
+"""
+import argparse
+import html
+import random
+import threading
+import time
+from email.message import EmailMessage
+
+from flask import Flask, abort, jsonify, request
+from werkzeug.serving import WSGIRequestHandler, run_simple
+
+import config
+from tasks import TASKS
+
+app = Flask(__name__)
+
+# injected latency and failures, set from the command line
+settings = {
+    "latency": 0.0,
+    "jitter": 0.0,
+    "failure_rate": 0.0,
+}
+
+bookings = []
+bookings_lock = threading.Lock()
+
+
+def get_checks(check_name):
+    return [check for task in TASKS for check in task.checks
+            if type(check).__name__ == check_name]
+
+
+def as_list(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
+@app.before_request
+def inject_latency_and_failures():
+    delay = settings["latency"] + random.uniform(0, settings["jitter"])
+    if delay:
+        time.sleep(delay)
+    if settings["failure_rate"] and random.random() < settings["failure_rate"]:
+        abort(500)
+
+
+@app.route("/")
+def home():
+    return "<html><body><h2>Search Trains</h2><form></form></body></html>"
+
+
+@app.route("/api/flags")
+def flags():
+    return jsonify({check.flag: True for check in get_checks("check_flag")})
+
+
+@app.route("/api/stations")
+def stations():
+    q = request.args.get("q", "")
+    for check in get_checks("check_autocomplete"):
+        if check.q == q:
+            return jsonify([{"code": code, "name": code} for code in check.expected_stations])
+    return jsonify([])
+
+
+@app.route("/api/search")
+def search():
+    key = (
+        request.args.get("from"),
+        request.args.get("to"),
+        request.args.get("class") or None,
+        request.args.getlist("dt"),
+        request.args.getlist("at"),
+    )
+    for check in get_checks("check_search_trains"):
+        check_key = (
+            check.from_station,
+            check.to_station,
+            check.ticket_class,
+            as_list(check.departure_time),
+            as_list(check.arrival_time),
+        )
+        if check_key == key:
+            return jsonify([make_train(n, check) for n in check.expected_trains])
+    return jsonify([])
+
+
+def make_train(number, check):
+    return {
+        "number": number,
+        "name": f"Train {number}",
+        "from_station_code": check.from_station,
+        "from_station_name": check.from_station,
+        "to_station_code": check.to_station,
+        "to_station_name": check.to_station,
+        "departure": "06:00",
+        "arrival": "11:00",
+        "duration_h": 5,
+        "duration_m": 0,
+    }
+
+
+def render_table(columns, rows):
+    def tr(cells, tag):
+        return "<tr>" + "".join(f"<{tag}>{html.escape(str(c))}</{tag}>" for c in cells) + "</tr>"
+
+    head = tr(columns, "th")
+    body = "\n".join(tr(row, "td") for row in rows)
+    return f"<table class='table'><thead>{head}</thead><tbody>\n{body}\n</tbody></table>"
+
+
+@app.route("/trains/<number>")
+def train_schedule(number):
+    rows = []
+    for check in get_checks("check_schedule"):
+        if str(check.train) == number:
+            rows.extend(check.ensure_rows)
+    table = render_table(["Code", "Station", "Day", "Arrival", "Departure"], rows)
+    return f"<html><body><h1>Train {number}</h1>{table}</body></html>"
+
+
+@app.route("/book-ticket", methods=["POST"])
+def book_ticket():
+    booking = {
+        "id": 0,
+        "train_number": request.form["train"],
+        "ticket_class": request.form["class"],
+        "date": request.form["date"],
+        "passenger_name": request.form["passenger_name"],
+        "passenger_email": request.form["passenger_email"],
+        "user": request.cookies.get("user"),
+    }
+    with bookings_lock:
+        booking["id"] = len(bookings) + 1
+        bookings.append(booking)
+    send_confirmation_email(booking)
+    return "<html><body>Booked</body></html>"
+
+
+def send_confirmation_email(booking):
+    # deliver straight to the mailbox of the catcher, as if it came over SMTP
+    from catcher import Mailbox
+
+    message = EmailMessage()
+    message["X-MailFrom"] = "rajdhani@localhost"
+    message["X-RcptTo"] = booking["passenger_email"]
+    message["Subject"] = f"Booking confirmed: train {booking['train_number']}"
+    message.set_content("Your ticket is booked.")
+    Mailbox(config.MAIL_DB).add(message)
+
+
+def get_stations(train_number):
+    for check in get_checks("check_booking"):
+        if check.train_number == train_number:
+            return check.from_station_code, check.to_station_code
+    return "", ""
+
+
+@app.route("/data-explorer")
+def data_explorer():
+    q = request.args.get("q", "")
+    with bookings_lock:
+        latest = bookings[-1:]
+
+    # the checks run only two kinds of queries, the latest booking and the
+    # latest booking joined with the train
+    if "JOIN" in q.upper():
+        columns = ["train_number", "ticket_class", "date", "passenger_name",
+                   "passenger_email", "from_station_code", "to_station_code"]
+        rows = [[b[c] for c in columns[:5]] + list(get_stations(b["train_number"])) for b in latest]
+    else:
+        columns = ["id", "train_number", "ticket_class", "date", "passenger_name", "passenger_email"]
+        rows = [[b[c] for c in columns] for b in latest]
+
+    table = render_table(["#"] + columns, [[i + 1] + row for i, row in enumerate(rows)])
+    return f"<html><body><h1>Data Explorer</h1>{table}</body></html>"
+
+
+@app.route("/login")
+def login():
+    response = app.make_response("<html><body>Logged in</body></html>")
+    response.set_cookie("user", request.args.get("email", ""))
+    return response
+
+
+@app.route("/bookings")
+def trips():
+    user = request.cookies.get("user")
+    with bookings_lock:
+        user_bookings = [b for b in bookings if user and b["user"] == user]
+
+    cards = "\n".join(
+        '<div class="card">'
+        f'<div class="card-header">Train {b["train_number"]} ({b["train_number"]})</div>'
+        '<div class="card-body">'
+        f'<div class="mb-3">Date: {b["date"]}, Class: {b["ticket_class"]}</div>'
+        '</div></div>'
+        for b in user_bookings)
+    return f"<html><body>{cards}</body></html>"
+
+
+def main():
+    p = argparse.ArgumentParser(description="Run a fake Rajdhani site")
+    p.add_argument("--port", type=int, default=5050)
+    p.add_argument("--latency", type=float, default=0, help="latency of every response in ms")
+    p.add_argument("--jitter", type=float, default=0, help="random extra latency up to these many ms")
+    p.add_argument("--failure-rate", type=float, default=0,
+                   help="fraction of the requests that fail with 500")
+    args = p.parse_args()
+
+    settings["latency"] = args.latency / 1000
+    settings["jitter"] = args.jitter / 1000
+    settings["failure_rate"] = args.failure_rate
+
+    # keep-alive, like the sites behind the proxy
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    run_simple("localhost", args.port, app, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""Benchmarks the verification and the pages of the app end to end,
+against local stand-ins of the participants' sites (bench/fakesite.py).
+
+The benchmark starts the fake sites, one process per port from 5050, and
+uses a temporary database, mail database and http cache, so it doesn't
+touch the files of the app. It measures:
+
+- a full verification of one site, run after run
+- the throughput of verifying many sites at the same time
+- an incremental verification, resumed from the last task
+- saving the status of an app in the database
+- the leader board and the app page with many apps in the database
+
+The results can be saved with --json to compare them across commits.
+
+Usage:
+
+    $ python -m bench.run [-n RUNS] [--sites N] [--apps N] [--latency MS] [--json FILE]
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+BASE_PORT = 5050
+
+
+def start_fake_sites(n, env, args):
+    """Starts n fake sites at the ports from BASE_PORT and returns the
+    processes once all of them accept connections.
+    """
+    options = [
+        "--latency", str(args.latency),
+        "--jitter", str(args.jitter),
+        "--failure-rate", str(args.failure_rate),
+    ]
+    for i in range(n):
+        if is_listening(BASE_PORT + i):
+            raise RuntimeError(f"port {BASE_PORT + i} is in use, stop the server running there")
+
+    procs = []
+    for i in range(n):
+        cmd = [sys.executable, "-m", "bench.fakesite", "--port", str(BASE_PORT + i)] + options
+        procs.append(subprocess.Popen(cmd, cwd=ROOT, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+    for i in range(n):
+        wait_for_port(BASE_PORT + i)
+    return procs
+
+
+def is_listening(port):
+    try:
+        with socket.create_connection(("localhost", port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while not is_listening(port):
+        if time.time() > deadline:
+            raise RuntimeError(f"fake site didn't start at port {port}")
+        time.sleep(0.1)
+
+
+def make_site(port):
+    """Returns a Site for the fake site at the port.
+
+    Every fake site gets a domain of its own, so that the sites have their
+    own connection pools and limits, like the sites of the participants.
+    """
+    import transport
+    from tasks import Site, get_site_limit
+
+    site = Site("localhost")
+    site.domain = f"localhost:{port}"
+    site.base_url = f"http://localhost:{port}"
+    site.shared_session = site.session = transport.get_session(site.domain)
+    site.limit = get_site_limit(site.domain)
+    return site
+
+
+def count_requests():
+    import metrics
+    with metrics.http_requests._lock:
+        return sum(metrics.http_requests._values.values())
+
+
+@contextlib.contextmanager
+def quiet():
+    """Hides the progress printed by the checks.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def summarize(times):
+    times = sorted(times)
+    return {
+        "runs": len(times),
+        "median_ms": statistics.median(times) * 1000,
+        "p95_ms": times[min(len(times) - 1, int(len(times) * 0.95))] * 1000,
+        "min_ms": times[0] * 1000,
+    }
+
+
+def timed(func, runs):
+    times = []
+    result = None
+    for i in range(runs):
+        t0 = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t0)
+    return times, result
+
+
+def bench_verify(runs):
+    site = make_site(BASE_PORT)
+    requests0 = count_requests()
+    with quiet():
+        times, status = timed(site.get_status, runs)
+    result = summarize(times)
+    result["requests_per_run"] = (count_requests() - requests0) / runs
+    result["passed"] = sum(1 for t in status["tasks"].values() if t["status"] == "pass")
+    result["tasks"] = len(status["tasks"])
+    return result, status
+
+
+def bench_concurrent(nsites, runs):
+    sites = [make_site(BASE_PORT + i) for i in range(nsites)]
+
+    def verify_site(site):
+        statuses = []
+        for i in range(runs):
+            statuses.append(site.get_status())
+        return statuses
+
+    t0 = time.perf_counter()
+    with quiet(), ThreadPoolExecutor(nsites) as executor:
+        results = list(executor.map(verify_site, sites))
+    elapsed = time.perf_counter() - t0
+
+    statuses = [status for statuses in results for status in statuses]
+    return {
+        "sites": nsites,
+        "runs": len(statuses),
+        "elapsed_s": elapsed,
+        "runs_per_s": len(statuses) / elapsed,
+        "all_passed": sum(1 for s in statuses if all(t["status"] == "pass" for t in s["tasks"].values())),
+    }
+
+
+def bench_incremental(runs, status):
+    site = make_site(BASE_PORT)
+    with quiet():
+        times, _ = timed(lambda: site.get_status(start_at=status["current_task"]), runs)
+    return summarize(times)
+
+
+def create_database(path, napps):
+    conn = sqlite3.connect(path)
+    conn.executescript((ROOT / "schema.sql").read_text())
+    conn.executemany(
+        "INSERT INTO app (name, current_task, score) VALUES (?, 'homepage', 0)",
+        [(f"app{i:04d}",) for i in range(napps)])
+    conn.commit()
+    conn.close()
+
+
+def bench_database(runs, status):
+    from db import App
+
+    apps = App.find_all()
+    counter = itertools.count()
+
+    def update_status():
+        app = apps[next(counter) % len(apps)]
+        app.update_status(status)
+
+    times, _ = timed(update_status, runs)
+    return summarize(times)
+
+
+def bench_pages(runs):
+    from app import app
+
+    client = app.test_client()
+    results = {}
+    for path in ["/", "/app0000"]:
+        def get():
+            response = client.get(path)
+            assert response.status_code == 200, f"{path} returned {response.status_code}"
+        times, _ = timed(get, runs)
+        results[path] = summarize(times)
+    return results
+
+
+def print_times(title, result):
+    print(f"  {title:<28} median {result['median_ms']:8.1f} ms   p95 {result['p95_ms']:8.1f} ms"
+          f"   min {result['min_ms']:8.1f} ms")
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark the verification against local fake sites")
+    p.add_argument("-n", "--runs", type=int, default=10, help="number of runs of each measurement (default: 10)")
+    p.add_argument("--sites", type=int, default=4, help="number of fake sites verified at the same time (default: 4)")
+    p.add_argument("--apps", type=int, default=500, help="number of apps in the database (default: 500)")
+    p.add_argument("--latency", type=float, default=0, help="latency of the fake sites in ms")
+    p.add_argument("--jitter", type=float, default=0, help="random extra latency of the fake sites in ms")
+    p.add_argument("--failure-rate", type=float, default=0, help="fraction of the requests that fail with 500")
+    p.add_argument("--json", help="save the results to this file")
+    args = p.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="rajdhani-bench-")
+    db_path = os.path.join(tmpdir, "rajdhani.db")
+    create_database(db_path, args.apps)
+
+    # the settings are read when the modules are imported, so they are set
+    # before importing any of them
+    env = dict(os.environ,
+        RAJDHANI_DB_URI=f"sqlite:///{db_path}",
+        RAJDHANI_MAIL_DB=os.path.join(tmpdir, "mail.db"),
+        RAJDHANI_HTTP_CACHE=os.path.join(tmpdir, "cache.db"))
+    os.environ.update(env)
+
+    # don't log every query
+    import web
+    web.config.debug = False
+
+    procs = start_fake_sites(args.sites, env, args)
+    try:
+        results = {"args": vars(args)}
+
+        verify, status = bench_verify(args.runs)
+        results["verify"] = verify
+        results["concurrent"] = bench_concurrent(args.sites, args.runs)
+        results["incremental"] = bench_incremental(args.runs, status)
+        results["update_status"] = bench_database(args.runs, status)
+        results["pages"] = bench_pages(args.runs)
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    print(f"Verification ({verify['passed']}/{verify['tasks']} tasks passed,"
+          f" {verify['requests_per_run']:.1f} requests per run)")
+    print_times("full", verify)
+    print_times("incremental", results["incremental"])
+    c = results["concurrent"]
+    print(f"  {c['sites']} sites at the same time    {c['runs_per_s']:8.2f} runs/s"
+          f"   ({c['all_passed']}/{c['runs']} runs passed all tasks)")
+    print(f"Database ({args.apps} apps)")
+    print_times("update_status", results["update_status"])
+    for path, result in results["pages"].items():
+        print_times(f"GET {path}", result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved the results to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Measures the cold start time of the app.
+
+Under the CGI-style hosting, the app is imported afresh for a request.
+Every measurement here runs in a new python process, imports the app and
+serves one request to the given path.
+
+Usage:
+
+    $ python -m bench.startup [-n RUNS] [--importtime] [path ...]
+
+The default paths are the leader board (/) and, when --app is given, the
+page of that app.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# modules that are required only for verifying the sites
+HEAVY_MODULES = ["requests", "urllib3", "bs4", "lxml", "yaml", "markdown"]
+
+SCRIPT = """
+import sys, time, json
+t0 = time.perf_counter()
+from app import app
+t1 = time.perf_counter()
+status = app.test_client().get(%(path)r).status_code
+t2 = time.perf_counter()
+heavy = [m for m in %(heavy)r if m in sys.modules]
+print(json.dumps({"import": t1-t0, "request": t2-t1, "status": status, "heavy": heavy}))
+"""
+
+
+def run_once(path):
+    code = SCRIPT % {"path": path, "heavy": HEAVY_MODULES}
+    p = subprocess.run([sys.executable, "-c", code],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True)
+    return json.loads(p.stdout.strip().splitlines()[-1])
+
+
+def measure(path, runs):
+    results = [run_once(path) for i in range(runs)]
+    import_times = [r["import"] * 1000 for r in results]
+    request_times = [r["request"] * 1000 for r in results]
+    total_times = [a + b for a, b in zip(import_times, request_times)]
+
+    print(f"{path} (status {results[-1]['status']}, {runs} runs)")
+    print(f"  import app     median {statistics.median(import_times):7.1f} ms   min {min(import_times):7.1f} ms")
+    print(f"  first request  median {statistics.median(request_times):7.1f} ms   min {min(request_times):7.1f} ms")
+    print(f"  total          median {statistics.median(total_times):7.1f} ms   min {min(total_times):7.1f} ms")
+    print(f"  heavy modules loaded: {', '.join(results[-1]['heavy']) or 'none'}")
+
+
+def print_importtime(limit=20):
+    """Prints the modules that take the most time to import, using
+    python -X importtime.
+    """
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    rows = []
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+
+    print(f"Top {limit} imports by cumulative time:")
+    for cumulative_us, self_us, name in sorted(rows, reverse=True)[:limit]:
+        print(f"  {cumulative_us/1000:7.1f} ms {self_us/1000:7.1f} ms {name}")
+
+
+def main():
+    p = argparse.ArgumentParser(description="Measure the cold start time of the app")
+    p.add_argument("-n", "--runs", type=int, default=10, help="number of runs per path (default: 10)")
+    p.add_argument("--app", help="name of an app to measure the app page of")
+    p.add_argument("--importtime", action="store_true", help="show the slowest imports")
+    p.add_argument("paths", nargs="*", help="paths to request")
+    args = p.parse_args()
+
+    paths = args.paths or ["/"]
+    if args.app:
+        paths.append(f"/{args.app}")
+
+    for path in paths:
+        measure(path, args.runs)
+    if args.importtime:
+        print()
+        print_importtime()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Compares the table extraction using BeautifulSoup with the streaming
+extractor in tables.py, on generated pages with large tables.
+
+Usage:
+
+    $ python -m bench.tables [-n RUNS] [--rows N ...]
+"""
+import argparse
+import statistics
+import time
+
+from bs4 import BeautifulSoup
+
+import tables
+
+
+def make_page(nrows, ncols=8):
+    """Returns an html page like /data-explorer with a table of nrows
+    rows, followed by some more content.
+    """
+    header = "".join(f"<th>column_{j}</th>" for j in range(ncols))
+    rows = "".join(
+        "<tr>" + "".join(f"<td> value {i}-{j} </td>" for j in range(ncols)) + "</tr>\n"
+        for i in range(nrows))
+    footer = "<p>footer</p>\n" * 1000
+    return (
+        "<!doctype html><html><head><title>Data Explorer</title></head><body>"
+        "<h1>Data Explorer</h1><form><textarea>SELECT * FROM booking</textarea></form>"
+        f"<table class='table'><thead><tr>{header}</tr></thead><tbody>{rows}</tbody></table>"
+        f"{footer}</body></html>")
+
+
+def extract_table_soup(html):
+    # the implementation of Site.extract_table before tables.py
+    soup = BeautifulSoup(html, "lxml")
+    table = soup.select("table")[0]
+    return parse_table(table)
+
+
+def parse_table(table):
+    return [parse_row(tr) for tr in table.select("tr")]
+
+
+def parse_row(tr):
+    return [cell.text.strip() for cell in tr.select("th,td")]
+
+
+def timeit(func, html, runs):
+    times = []
+    for i in range(runs):
+        t0 = time.perf_counter()
+        func(html)
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times) * 1000
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark the table extraction")
+    p.add_argument("-n", "--runs", type=int, default=5, help="number of runs (default: 5)")
+    p.add_argument("--rows", type=int, nargs="*", default=[10, 100, 1000, 10000],
+                   help="sizes of the tables (default: 10 100 1000 10000)")
+    args = p.parse_args()
+
+    print(f"{'rows':>8} {'page KB':>8} {'soup ms':>10} {'stream ms':>10} {'speedup':>8}")
+    for nrows in args.rows:
+        html = make_page(nrows)
+        assert tables.extract_table(html) == extract_table_soup(html)
+
+        soup_ms = timeit(extract_table_soup, html, args.runs)
+        stream_ms = timeit(tables.extract_table, html, args.runs)
+        print(f"{nrows:>8} {len(html)//1024:>8} {soup_ms:>10.2f} {stream_ms:>10.2f} {soup_ms/stream_ms:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
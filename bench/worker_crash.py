@@ -0,0 +1,99 @@
+"""Checks that the job of a worker that dies is taken over by another
+worker once its lease expires.
+
+A worker is started on a job against a slow fake site and is killed in
+the middle of the job. A second worker is started then and it must claim
+the job after the lease expires and finish it.
+
+Usage:
+
+    $ python -m bench.worker_crash [--lease SECONDS]
+"""
+import argparse
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.run import BASE_PORT, ROOT, create_database, start_fake_sites
+
+
+def start_worker(env):
+    return subprocess.Popen([sys.executable, "worker.py", "-n", "1"], cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_for(predicate, timeout, message):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError(message)
+        time.sleep(0.2)
+
+
+def main():
+    p = argparse.ArgumentParser(description="Kill a worker in the middle of a job")
+    p.add_argument("--lease", type=float, default=3, help="lease of the jobs in seconds (default: 3)")
+    p.add_argument("--latency", type=float, default=200,
+                   help="latency of the fake site in ms, to make the job slow (default: 200)")
+    args = p.parse_args()
+    args.jitter = args.failure_rate = 0
+
+    tmpdir = tempfile.mkdtemp(prefix="rajdhani-worker-crash-")
+    db_path = os.path.join(tmpdir, "rajdhani.db")
+    create_database(db_path, 0)
+
+    env = dict(os.environ,
+        RAJDHANI_DB_URI=f"sqlite:///{db_path}",
+        RAJDHANI_MAIL_DB=os.path.join(tmpdir, "mail.db"),
+        RAJDHANI_HTTP_CACHE="",
+        RAJDHANI_JOB_QUEUE="db",
+        RAJDHANI_JOB_LEASE=str(args.lease))
+    os.environ.update(env)
+
+    import web
+    web.config.debug = False
+    from db import App
+    from jobs import DBJob
+
+    procs = start_fake_sites(1, env, args)
+    workers = []
+    try:
+        App.create("localhost")
+        job = DBJob.submit("localhost")
+        print(f"Submitted job {job.id}, verifying the fake site at port {BASE_PORT}")
+
+        first = start_worker(env)
+        workers.append(first)
+        wait_for(lambda: DBJob.find(job.id).status == "running", 30, "the first worker didn't claim the job")
+        time.sleep(1)
+        os.kill(first.pid, signal.SIGKILL)
+        first.wait()
+        killed_at = time.time()
+        print(f"Killed the first worker (pid {first.pid}) in the middle of the job")
+
+        second = start_worker(env)
+        workers.append(second)
+        wait_for(lambda: f":{second.pid}:" in (DBJob.find(job.id).worker or ""), args.lease + 30,
+                 "the second worker didn't take over the job")
+        print(f"The second worker (pid {second.pid}) took over the job after {time.time() - killed_at:.1f}s")
+
+        wait_for(lambda: DBJob.find(job.id).is_finished(), 120, "the job didn't finish")
+        job = DBJob.find(job.id)
+        assert job.status == "done", f"the job {job.status}: {job.error}"
+        assert job.attempts == 2, f"expected 2 attempts, found {job.attempts}"
+        print(f"The job is done in {job.attempts} attempts, current task: {job.result['current_task']}")
+        print("OK")
+    finally:
+        for proc in workers + procs:
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
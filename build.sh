@@ -1,4 +1,15 @@
 # NOTE: by hamr convention, this should ideally be in $APP_ROOT/private/
 # directory, but all the rajdhani projects also follow the same convention
 # that the database will be in the same folder as the app directory.
-sqlite3 $APP_ROOT/app/rajdhani.db < $APP_ROOT/app/schema.sql
+
+# create the database on the first deploy and upgrade it in place after that
+if [ ! -f $APP_ROOT/app/rajdhani.db ]; then
+    sqlite3 $APP_ROOT/app/rajdhani.db < $APP_ROOT/app/schema.sql
+fi
+cd $APP_ROOT/app && python migrate.py
+
+# the app only saves the verification jobs in the job table, they are run
+# by the worker processes. Keep at least one of them running, next to the
+# app and against the same database:
+#
+#   cd $APP_ROOT/app && python worker.py -n 4
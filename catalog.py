@@ -0,0 +1,109 @@
+"""Catalog of the tasks, compiled from tasks.yml.
+
+Compiling the catalog parses the yaml, creates the check objects and
+renders the description of every task from markdown. The compiled tasks
+are pickled to a file in the cache directory, keyed by the hash of
+tasks.yml (and of tasks.py, which defines the checks), so that a version
+of the file is compiled only once.
+
+The catalog looks at the mtime of tasks.yml, at most once every
+RAJDHANI_CATALOG_CHECK_INTERVAL seconds, and reloads it when it has
+changed. The reload replaces the list of tasks in one assignment, so the
+tasks can be edited while the server is running. When the changed file
+fails to compile, the error is printed and the previous tasks are kept.
+"""
+import hashlib
+import os
+import pickle
+import threading
+import time
+import traceback
+from pathlib import Path
+
+import config
+
+
+class Catalog:
+    def __init__(self, path):
+        self.path = path
+        self._tasks = None
+        self._mtime = None
+        self._last_checked = 0
+        self._lock = threading.Lock()
+
+    @property
+    def tasks(self):
+        """Returns the list of tasks, reloading them if tasks.yml has
+        changed.
+
+        Use the same list for the whole verification run, the catalog may
+        get reloaded in between.
+        """
+        now = time.monotonic()
+        if self._tasks is None or now - self._last_checked > config.CATALOG_CHECK_INTERVAL:
+            self._reload_if_changed(now)
+        return self._tasks
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __getitem__(self, index):
+        return self.tasks[index]
+
+    def _reload_if_changed(self, now):
+        with self._lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime != self._mtime:
+                    # the mtime is recorded even when the load fails, so the
+                    # broken file is not compiled again on every access
+                    self._mtime = mtime
+                    self._tasks = self.load()
+            except Exception:
+                if self._tasks is None:
+                    # nothing to serve, try again on the next access
+                    self._mtime = None
+                    raise
+                print(f"Failed to reload {self.path}, keeping the previous tasks")
+                traceback.print_exc()
+            self._last_checked = now
+
+    def load(self):
+        """Loads the compiled tasks from the cache, compiling them if they
+        are not in the cache already.
+        """
+        cache_path = self.get_cache_path()
+        try:
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, AttributeError, EOFError):
+            pass
+
+        tasks = self.compile()
+
+        # write to a temp file and rename it, so that the other processes
+        # never see a partially written file
+        os.makedirs(config.CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(tasks, f)
+        os.replace(tmp_path, cache_path)
+        return tasks
+
+    def get_cache_path(self):
+        h = hashlib.sha256()
+        h.update(Path(self.path).read_bytes())
+        h.update(Path(__file__).with_name("tasks.py").read_bytes())
+        return os.path.join(config.CACHE_DIR, f"tasks-{h.hexdigest()[:16]}.pickle")
+
+    def compile(self):
+        import markdown
+        from tasks import Task
+
+        tasks = Task.load_from_file(self.path)
+        for task in tasks:
+            task.description_html = markdown.markdown(task.description)
+        return tasks
@@ -1,49 +1,121 @@
+"""SMTP server to catch the emails sent by the participants' sites.
+
+Every message is saved in a sqlite database, with a row for each of its
+recipients, indexed by the recipient and the time of arrival. The checks
+wait for a message to their own recipient instead of reading the last
+message received.
+
+Usage:
+
+    $ python catcher.py [rajdhani-mail.db]
+"""
+import sqlite3
 import sys
-from email.generator import Generator
+import threading
+import time
 from email.parser import Parser
 from aiosmtpd.handlers import Message
 from aiosmtpd.controller import Controller
 
+import config
+
+SCHEMA = """
+create table if not exists message (
+    id integer primary key,
+    recipient text,
+    mail_from text,
+    received real,
+    body text
+);
+create index if not exists message_recipient_received on message(recipient, received);
+"""
+
+
+class Mailbox:
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        return conn
+
+    def add(self, message):
+        """Saves an email.message.Message, received by the SMTP server.
+        """
+        recipients = [r.strip().lower() for r in message["X-RcptTo"].split(",") if r.strip()]
+        body = message.as_string()
+        received = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO message (recipient, mail_from, received, body) VALUES (?, ?, ?, ?)",
+                    [(r, message["X-MailFrom"], received, body) for r in recipients])
+        finally:
+            conn.close()
 
-class MailFile(Message):
-    def __init__(self, mail_file, message_class=None):
-        self.mail_file = mail_file
+    def find(self, recipient, since=0):
+        """Returns the latest message to the recipient received after the
+        since timestamp, or None if there is no such message.
+
+        The message is an email.message.Message and it can be used like this:
+        `message["X-MailFrom"]`
+        `message["X-RcptTo"]`
+        `message.get_payload() -> str | list[str]`
+        `message.is_multipart() -> bool`
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT body FROM message"
+                " WHERE recipient=? AND received >= ?"
+                " ORDER BY received DESC LIMIT 1",
+                (recipient.lower(), since)).fetchone()
+        finally:
+            conn.close()
+        return row and Parser().parsestr(row[0])
+
+    def wait_for(self, recipient, since, timeout, interval=0.5):
+        """Waits till a message to the recipient, received after the since
+        timestamp, arrives and returns it. Returns None if it doesn't
+        arrive in timeout seconds.
+        """
+        deadline = time.time() + timeout
+        while True:
+            message = self.find(recipient, since)
+            if message or time.time() >= deadline:
+                return message
+            time.sleep(interval)
+
+
+class MailboxHandler(Message):
+    def __init__(self, mailbox, message_class=None):
+        self.mailbox = mailbox
         super().__init__(message_class=message_class)
 
     def handle_message(self, message):
-        with open(self.mail_file, "w") as f:
-            g = Generator(f, mangle_from_=True, maxheaderlen=120)
-            g.flatten(message)
+        self.mailbox.add(message)
 
     @classmethod
     def from_cli(cls, parser, *args):
         if len(args) < 1:
-            parser.error("The file for the mailfile is required")
+            parser.error("The file for the mailbox is required")
         elif len(args) > 1:
             parser.error("Too many arguments for Mailbox handler")
-        return cls(args[0])
-
-
-def get_latest_message(mail_file):
-    """Returns email.message.Message class object
-
-    Message class can be used like this:
-    `message["X-MailFrom"]`
-    `message["X-RcptTo"]`
-    `message.get_payload() -> str | list[str]`
-    `message.is_multipart() -> bool`
-    """
-    p = Parser()
-    with open(mail_file) as f:
-        return p.parse(f)
+        return cls(Mailbox(args[0]))
 
 
 if __name__ == "__main__":
-    mail_file = sys.argv[1] if len(sys.argv) > 1 else "rajdhani.mail"
+    path = sys.argv[1] if len(sys.argv) > 1 else config.MAIL_DB
 
-    controller = Controller(MailFile(mail_file), hostname="", port=8025)
+    controller = Controller(MailboxHandler(Mailbox(path)), hostname="", port=8025)
     controller.start()
 
-    # controller thread has started
-    while True:
-        pass
+    # the controller runs the server in its own thread, wait here till
+    # the process is interrupted
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        controller.stop()
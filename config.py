@@ -0,0 +1,104 @@
+"""Configuration of the rajdhani challenge server.
+
+Every setting can be overridden by an environment variable of the same
+name prefixed with RAJDHANI_.
+"""
+import os
+
+# number of worker threads that verify the apps in the background
+WORKERS = int(os.getenv("RAJDHANI_WORKERS", "4"))
+
+# number of finished jobs to remember for the job-status endpoint
+MAX_JOBS = int(os.getenv("RAJDHANI_MAX_JOBS", "1000"))
+
+# where the verification jobs are kept. With "db", they are saved in the
+# job table and run by the worker processes started with worker.py. With
+# "memory", they are run by the worker threads of the app, which works only
+# when the app is a long running process, like the development server.
+JOB_QUEUE = os.getenv("RAJDHANI_JOB_QUEUE", "db")
+
+# seconds a worker holds a job for without renewing the lease, the number
+# of times a job is attempted before it is marked as failed and the days
+# to keep the finished jobs in the job table
+JOB_LEASE = float(os.getenv("RAJDHANI_JOB_LEASE", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("RAJDHANI_JOB_MAX_ATTEMPTS", "3"))
+JOB_RETENTION_DAYS = int(os.getenv("RAJDHANI_JOB_RETENTION_DAYS", "7"))
+
+# port at which a worker process exports its metrics, 0 to not export them
+WORKER_METRICS_PORT = int(os.getenv("RAJDHANI_WORKER_METRICS_PORT", "9100"))
+
+# the status of an app is considered stale after these many seconds and
+# only then a re-verification can be requested from the app page
+STATUS_TTL = int(os.getenv("RAJDHANI_STATUS_TTL", "300"))
+
+# number of checks of a task that are run in parallel, 1 runs them one
+# after the other
+CHECK_CONCURRENCY = int(os.getenv("RAJDHANI_CHECK_CONCURRENCY", "4"))
+
+# verify the read-only tasks ahead of the current task in parallel, up to
+# TASK_CONCURRENCY at a time. The results are same as verifying them one
+# after the other.
+SPECULATIVE = os.getenv("RAJDHANI_SPECULATIVE", "0") == "1"
+TASK_CONCURRENCY = int(os.getenv("RAJDHANI_TASK_CONCURRENCY", "4"))
+
+# maximum number of requests in flight to a participant's site
+SITE_CONCURRENCY = int(os.getenv("RAJDHANI_SITE_CONCURRENCY", "4"))
+
+# verify only from the current task onwards when the fingerprint of the
+# site hasn't changed since the last verification
+INCREMENTAL = os.getenv("RAJDHANI_INCREMENTAL", "1") == "1"
+
+# all the tasks are verified again if the last full verification is
+# older than these many seconds
+FULL_CHECK_INTERVAL = int(os.getenv("RAJDHANI_FULL_CHECK_INTERVAL", str(6*3600)))
+
+# timeouts in seconds for the requests made to the participants' sites
+HTTP_CONNECT_TIMEOUT = float(os.getenv("RAJDHANI_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("RAJDHANI_HTTP_READ_TIMEOUT", "30"))
+
+# number of times a failed GET request is retried and the backoff factor
+# for the delay between the retries
+HTTP_RETRIES = int(os.getenv("RAJDHANI_HTTP_RETRIES", "2"))
+HTTP_BACKOFF = float(os.getenv("RAJDHANI_HTTP_BACKOFF", "0.5"))
+
+# seconds a check and a whole verification of a site may take, after
+# which the remaining checks are marked as errors. 0 means no limit.
+CHECK_TIMEOUT = float(os.getenv("RAJDHANI_CHECK_TIMEOUT", "60"))
+RUN_TIMEOUT = float(os.getenv("RAJDHANI_RUN_TIMEOUT", "600"))
+
+# after these many consecutive connection failures, the verification of
+# a site is skipped for BREAKER_COOLDOWN seconds. 0 disables it.
+BREAKER_THRESHOLD = int(os.getenv("RAJDHANI_BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("RAJDHANI_BREAKER_COOLDOWN", "300"))
+
+# number of keep-alive connections kept open to each site
+HTTP_POOL_SIZE = int(os.getenv("RAJDHANI_HTTP_POOL_SIZE", str(SITE_CONCURRENCY)))
+
+# path of the on-disk cache of the responses from the sites and its
+# maximum size in MB. The cache is disabled when the path is empty.
+HTTP_CACHE = os.getenv("RAJDHANI_HTTP_CACHE", "rajdhani-cache.db")
+HTTP_CACHE_SIZE = int(os.getenv("RAJDHANI_HTTP_CACHE_SIZE", "64")) * 1024 * 1024
+
+# changelog entries older than these many days are deleted, 0 keeps them
+# forever
+CHANGELOG_RETENTION_DAYS = int(os.getenv("RAJDHANI_CHANGELOG_RETENTION_DAYS", "90"))
+
+# storage mode of the sqlite database. In the "wal" mode, the database
+# uses write-ahead logging and all the writes go through a single writer
+# thread. Use "default" to write from the request threads directly.
+DB_MODE = os.getenv("RAJDHANI_DB_MODE", "wal")
+
+# seconds to wait for a lock on the sqlite database before failing
+DB_BUSY_TIMEOUT = float(os.getenv("RAJDHANI_DB_BUSY_TIMEOUT", "30"))
+
+# directory to keep the compiled task catalog
+CACHE_DIR = os.getenv("RAJDHANI_CACHE_DIR", ".cache")
+
+# seconds between the checks for changes to tasks.yml
+CATALOG_CHECK_INTERVAL = float(os.getenv("RAJDHANI_CATALOG_CHECK_INTERVAL", "2"))
+
+# database of the emails caught by catcher.py and the seconds to wait for
+# the confirmation email after a booking. It is a local file, so the
+# workers run on the same host as the catcher.
+MAIL_DB = os.getenv("RAJDHANI_MAIL_DB", "rajdhani-mail.db")
+MAIL_TIMEOUT = float(os.getenv("RAJDHANI_MAIL_TIMEOUT", "15"))
@@ -2,9 +2,114 @@ import os
 import web
 import json
 import datetime
+import functools
+import queue
+import threading
+from concurrent.futures import Future
+
+import config
+import metrics
 
 db_uri = os.getenv("RAJDHANI_DB_URI", "sqlite:///rajdhani.db")
-db = web.database(db_uri)
+db_params = web.db.dburl2dict(db_uri)
+is_sqlite = db_params["dbn"] == "sqlite"
+if is_sqlite:
+    # wait for the lock instead of failing with "database is locked"
+    db_params["timeout"] = config.DB_BUSY_TIMEOUT
+db = web.database(**db_params)
+
+
+class Writer:
+    """Runs all the writes to the database in a single thread.
+
+    The writes submitted together are batched into a single transaction.
+    Each write runs in its own savepoint, so that a failing write doesn't
+    undo the others.
+    """
+    def __init__(self, batch_size=50):
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def is_writer_thread(self):
+        return threading.current_thread() is self.thread
+
+    def submit(self, func, *args, **kwargs):
+        """Submits func to be called in the writer thread and returns a
+        Future for its result.
+        """
+        with self._lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="db-writer", daemon=True)
+                self.thread.start()
+        future = Future()
+        self.queue.put((future, func, args, kwargs))
+        return future
+
+    def run(self):
+        # with write-ahead logging, the readers don't block the writer and
+        # the writer doesn't block the readers. This is a persistent
+        # setting of the database and is done here, instead of at import,
+        # to avoid opening the database on every import.
+        db.query("PRAGMA journal_mode=WAL")
+
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.write_batch(batch)
+
+    def write_batch(self, batch):
+        results = []
+        try:
+            with db.transaction():
+                # take the write lock before the first read, a deferred
+                # transaction that reads and then writes fails at once with
+                # "database is locked" when another process is writing,
+                # without waiting for the busy timeout
+                db.query("BEGIN IMMEDIATE")
+                for future, func, args, kwargs in batch:
+                    try:
+                        with db.transaction():
+                            results.append((future, func(*args, **kwargs), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+        except Exception as e:
+            # the commit failed, none of the writes are saved
+            results = [(future, None, e) for future, func, args, kwargs in batch]
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+def writes(func):
+    """Decorator to run a function that writes to the database in the
+    writer thread, when the writer is enabled.
+    """
+    @functools.wraps(func)
+    def timed(*args, **kwargs):
+        with metrics.db_write_duration.time(operation=func.__name__):
+            return func(*args, **kwargs)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if writer is None or writer.is_writer_thread():
+            return timed(*args, **kwargs)
+        return writer.submit(timed, *args, **kwargs).result()
+    return wrapper
+
+
+if is_sqlite and config.DB_MODE == "wal":
+    writer = Writer()
+else:
+    writer = None
 
 
 class App:
@@ -15,10 +120,33 @@ class App:
         self.score = row.score
         self.created = self.parse_timestamp(row.created)
         self.last_updated = self.parse_timestamp(row.last_updated)
+        self.fingerprint = row.get("fingerprint")
+        self.last_full_check = row.get("last_full_check") and self.parse_timestamp(row.last_full_check)
 
     def parse_timestamp(self, timestamp):
         return datetime.datetime.fromisoformat(timestamp)
 
+    def can_resume(self, fingerprint, full_check_interval):
+        """Tells if the verification of the site can start from the current
+        task, skipping the tasks that have passed already.
+
+        That is possible only when the fingerprint of the site is same as
+        the last time and the last full verification is recent enough.
+        """
+        if fingerprint is None or fingerprint != self.fingerprint:
+            return False
+        if self.last_full_check is None:
+            return False
+        age = datetime.datetime.utcnow() - self.last_full_check
+        return age.total_seconds() < full_check_interval
+
+    def is_stale(self, ttl):
+        """Tells if the status of the app was last updated more than
+        ttl seconds ago.
+        """
+        age = datetime.datetime.utcnow() - self.last_updated
+        return age.total_seconds() > ttl
+
     @classmethod
     def find_all(cls):
         rows = db.select("app", order="score desc")
@@ -32,6 +160,7 @@ class App:
             return cls(row)
 
     @classmethod
+    @writes
     def create(cls, name, git_url=None):
         db.insert(
             "app",
@@ -45,62 +174,177 @@ class App:
         rows = db.where("task", app_id=self.id, name=task_name)
         return bool(rows)
 
+    @writes
     def mark_task_as_done(self, task_name):
         self.add_changelog("task-done", f"Completed task {task_name}.")
         db.insert("completed_tasks", app_id=self.id, task=task_name)
 
-    def get_changelog(self):
-        rows = db.where("changelog", app_id=self.id, order="timestamp desc")
+    def get_changelog(self, limit=None, before=None):
+        """Returns the changelog entries of this app, the latest first.
+
+        At most limit entries are returned. To get the next page, pass
+        the id of the last entry as before.
+        """
+        where = "app_id=$app_id"
+        if before is not None:
+            where += " AND id < $before"
+        rows = db.select("changelog",
+            where=where,
+            vars={"app_id": self.id, "before": before},
+            order="timestamp desc, id desc",
+            limit=limit)
         return [self._process_changelog(row) for row in rows]
 
     def _process_changelog(self, row):
         row.timestamp = self.parse_timestamp(row.timestamp)
+        row.count = row.get("count") or 1
+        row.first_timestamp = row.get("first_timestamp") and self.parse_timestamp(row.first_timestamp)
         return row
 
+    @writes
     def add_changelog(self, type, message):
+        """Adds an entry to the changelog.
+
+        Consecutive deploy or site-unhealthy entries with the same message
+        are collapsed into a single entry with the number of times and the
+        time of the first one.
+        """
+        if type in ("deploy", "site-unhealthy"):
+            last = db.select("changelog",
+                where="app_id=$app_id",
+                vars={"app_id": self.id},
+                order="timestamp desc, id desc",
+                limit=1).first()
+            if last and last.type == type and last.message == message:
+                # the entry is replaced instead of updated to keep the
+                # ids in the order of time, which the pagination relies on
+                db.delete("changelog", where="id=$id", vars={"id": last.id})
+                db.insert("changelog",
+                    app_id=self.id,
+                    type=type,
+                    message=message,
+                    count=(last.get("count") or 1) + 1,
+                    first_timestamp=last.get("first_timestamp") or last.timestamp)
+                return
         db.insert("changelog", app_id=self.id, type=type, message=message)
 
+    @writes
+    def prune_changelog(self, days):
+        """Deletes the changelog entries older than the given number of days.
+        """
+        db.delete("changelog",
+            where="app_id=$app_id AND timestamp < $cutoff",
+            vars={"app_id": self.id, "cutoff": get_cutoff_timestamp(days)})
+
+    @writes
     def _update(self, **kwargs):
         db.update("app", **kwargs, where="id=$id", vars={"id": self.id})
 
-    def update_score(self):
-        rows = db.where("task", app_id=self.id, status='pass').list()
-        score = len(rows)
-        self._update(score=score)
-
+    @writes
     def update_status(self, status):
-        self.add_changelog("deploy", "Deployed the app")
-        self._update(current_task=status['current_task'])
+        """Saves the status of the app and all its tasks in a single
+        transaction.
+
+        When the site was not reachable, only a site-unhealthy entry is
+        added to the changelog and the tasks are left as they are.
+        """
+        if status.get("unreachable"):
+            with db.transaction():
+                self.add_changelog("site-unhealthy", "The site is not responding, skipped the verification")
+                self._update(last_updated=web.SQLLiteral("CURRENT_TIMESTAMP"))
+            return
 
-        for task_name, task_status in status['tasks'].items():
-            self.update_task_status(task_name, task_status)
+        with db.transaction():
+            self.add_changelog("deploy", "Deployed the app")
+            if config.CHANGELOG_RETENTION_DAYS:
+                self.prune_changelog(config.CHANGELOG_RETENTION_DAYS)
 
-        self.update_score()
+            previous = self.get_task_states()
+            tasks = status['tasks']
+            self.update_task_statuses(tasks)
 
-    def has_task(self, name):
-        return db.where("task", app_id=self.id, name=name).first() is not None
+            # the tasks that are not verified this time keep their status,
+            # so the score changes only by the tasks that are verified
+            passed = sum(1 for name, task_status in tasks.items()
+                         if task_status['status'] == 'pass' and previous.get(name) != 'pass')
+            broken = sum(1 for name, task_status in tasks.items()
+                         if task_status['status'] != 'pass' and previous.get(name) == 'pass')
+
+            updates = dict(
+                current_task=status['current_task'],
+                score=web.SQLLiteral("score + (%d)" % (passed - broken)),
+                last_updated=web.SQLLiteral("CURRENT_TIMESTAMP"))
+            if "fingerprint" in status:
+                updates["fingerprint"] = status["fingerprint"]
+            if status.get("full"):
+                updates["last_full_check"] = web.SQLLiteral("CURRENT_TIMESTAMP")
+            self._update(**updates)
+
+    def get_task_states(self):
+        """Returns the status of all the tasks of this app as a dict.
+        """
+        rows = db.select("task", what="name, status", where="app_id=$app_id", vars={"app_id": self.id})
+        return {row.name: row.status for row in rows}
 
     def get_task_status(self, name):
-        task_status = db.where("task", app_id=self.id, name=name).first()
-        if task_status:
-            task_status.checks = json.loads(task_status.checks)
-        return task_status
-
-    def update_task_status(self, name, task_status):
-        status = task_status['status']
-        checks = json.dumps(task_status['checks'])
-        if self.has_task(name):
-            db.update("task",
-                status=status,
-                checks=checks,
-                where="name=$name and app_id=$app_id",
-                vars={"name": name, "app_id": self.id})
-        else:
-            db.insert("task",
-                app_id=self.id,
-                name=name,
-                status=status,
-                checks=checks)
+        row = db.where("task", app_id=self.id, name=name).first()
+        return row and TaskRow(row)
+
+    def get_task_statuses(self):
+        """Returns the status of all the tasks of this app as a dict with
+        task name as key, using a single query.
+        """
+        rows = db.where("task", app_id=self.id)
+        return {row.name: TaskRow(row) for row in rows}
+
+    @writes
+    def update_task_statuses(self, tasks):
+        """Inserts or updates the status of many tasks in a single query.
+
+        The tasks is a dict with task name as key and task status as value.
+        """
+        if not tasks:
+            return
+
+        values = [
+            web.SQLQuery.join([
+                web.sqlquote(self.id),
+                web.sqlquote(name),
+                web.sqlquote(task_status['status']),
+                web.sqlquote(json.dumps(task_status['checks']))
+            ], ", ", prefix="(", suffix=")")
+            for name, task_status in tasks.items()
+        ]
+        query = (
+            "INSERT INTO task (app_id, name, status, checks) VALUES "
+            + web.SQLQuery.join(values, ", ")
+            + " ON CONFLICT (app_id, name) DO UPDATE SET"
+            + " status=excluded.status,"
+            + " checks=excluded.checks,"
+            + " timestamp=CURRENT_TIMESTAMP")
+        db.query(query)
+
+def get_cutoff_timestamp(days):
+    """Returns the timestamp of the given number of days ago, in the format
+    used by the timestamp columns.
+    """
+    t = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    return t.strftime("%Y-%m-%d %H:%M:%S")
+
+class TaskRow:
+    """Status of a task of an app.
+
+    The checks are decoded from json only when they are accessed.
+    """
+    def __init__(self, row):
+        self.name = row.name
+        self.status = row.status
+        self.timestamp = row.timestamp
+        self._checks = row.checks
+
+    @functools.cached_property
+    def checks(self):
+        return json.loads(self._checks)
 
 def main():
     import sys
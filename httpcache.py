@@ -0,0 +1,149 @@
+"""On-disk cache of the responses from the participants' sites.
+
+The responses that come with an ETag or a Last-Modified header are saved
+along with those validators. The next request to the same URL sends them
+as If-None-Match and If-Modified-Since and when the site responds with
+304 Not Modified, the saved body is used instead.
+
+The cache is also used to save the results of parsing the responses that
+can be validated, so that an unchanged page is not parsed again.
+
+The cache is a sqlite database bounded in size. The least recently used
+entries are evicted when it grows beyond that. It is shared by all the
+processes verifying the sites and it is only an optimization, so an error
+from the database, like when it is locked for too long by another
+process, is treated as a miss and the value is not saved.
+"""
+import sqlite3
+import threading
+import time
+
+import config
+
+SCHEMA = """
+create table if not exists entry (
+    key text primary key,
+    etag text,
+    last_modified text,
+    encoding text,
+    value blob,
+    size int,
+    last_access real
+);
+create index if not exists entry_last_access on entry(last_access);
+
+-- the total size of the entries, kept up to date by put and the eviction
+create table if not exists stats (total int);
+insert into stats (total)
+    select coalesce(sum(size), 0) from entry where not exists (select 1 from stats);
+"""
+
+# seconds to wait for the other processes to release the database, before
+# giving up on the cache
+BUSY_TIMEOUT = 1
+
+
+class HTTPCache:
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _get_conn(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None,
+                                   timeout=BUSY_TIMEOUT)
+            conn.row_factory = sqlite3.Row
+            # the readers don't block the writer and the writer doesn't
+            # block the readers
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def get(self, key):
+        """Returns the entry for the key as a dict, or None if there is
+        no entry for it or the cache can't be read.
+        """
+        with self._lock:
+            try:
+                conn = self._get_conn()
+                row = conn.execute("SELECT * FROM entry WHERE key=?", (key,)).fetchone()
+                if row is None:
+                    return None
+                conn.execute("UPDATE entry SET last_access=? WHERE key=?", (time.time(), key))
+                return dict(row)
+            except sqlite3.Error:
+                return None
+
+    def put(self, key, value, etag=None, last_modified=None, encoding=None):
+        """Saves the value for the key, evicting the least recently used
+        entries if the cache has grown too big. Nothing is saved if the
+        cache can't be written.
+        """
+        with self._lock:
+            try:
+                conn = self._get_conn()
+                conn.execute("BEGIN IMMEDIATE")
+                with conn:
+                    row = conn.execute("SELECT size FROM entry WHERE key=?", (key,)).fetchone()
+                    conn.execute(
+                        "INSERT OR REPLACE INTO entry"
+                        " (key, etag, last_modified, encoding, value, size, last_access)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (key, etag, last_modified, encoding, value, len(value), time.time()))
+                    conn.execute("UPDATE stats SET total = total + ?",
+                                 (len(value) - (row["size"] if row else 0),))
+                    self._evict(conn)
+            except sqlite3.Error:
+                pass
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT total FROM stats").fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        keys = []
+        freed = 0
+        for row in conn.execute("SELECT key, size FROM entry ORDER BY last_access"):
+            if total - freed <= self.max_size:
+                break
+            keys.append(row["key"])
+            freed += row["size"]
+        conn.executemany("DELETE FROM entry WHERE key=?", [(k,) for k in keys])
+        conn.execute("UPDATE stats SET total = total - ?", (freed,))
+
+
+def get_cache_headers(entry):
+    """Returns the headers to make a conditional request for the entry.
+    """
+    headers = {}
+    if entry and entry["etag"]:
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry["last_modified"]:
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def is_cacheable(response):
+    if response.status_code != 200:
+        return False
+    if "no-store" in response.headers.get("Cache-Control", ""):
+        return False
+    return "ETag" in response.headers or "Last-Modified" in response.headers
+
+
+def is_validated(response):
+    """Returns True if the body of the response came from the cache after
+    a 304, or it can be validated on the next request. Only then the same
+    body is likely to be seen again and the results of parsing it are
+    worth caching.
+    """
+    return getattr(response, "from_cache", False) or is_cacheable(response)
+
+
+if config.HTTP_CACHE:
+    cache = HTTPCache(config.HTTP_CACHE, max_size=config.HTTP_CACHE_SIZE)
+else:
+    cache = None
@@ -0,0 +1,570 @@
+"""Background verification of apps.
+
+Verifying a site makes live requests to the participant's deployment and
+that can take a long time. Instead of doing that in the request, the
+deploy endpoint submits a job to the queue and the workers run it.
+
+There is at most one verification of an app running at a time. The
+triggers that arrive while a job of the app is queued get that job, and
+the ones that arrive while it is running get a single trailing job that
+runs after it.
+
+The jobs are run in the order of their priority. The deploys and the
+re-verifications from the app page are interactive and they run before
+the background jobs, like the re-scoring of all the apps.
+
+By default, the jobs are saved in the job table and run by the worker
+processes started with worker.py. With RAJDHANI_JOB_QUEUE=memory, the jobs
+are kept in memory and run by the worker threads of the app. That is the
+default for the development server started with `python app.py`.
+"""
+import datetime
+import json
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+
+import web
+
+import config
+import metrics
+from db import App, db, get_cutoff_timestamp, writes
+from tasks import Site
+
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+# the priorities, highest first
+PRIORITIES = [INTERACTIVE, BACKGROUND]
+
+
+class Job:
+    def __init__(self, app_name, priority=INTERACTIVE, full=False):
+        self.id = uuid.uuid4().hex
+        self.app_name = app_name
+        self.priority = priority
+        self.full = full  # verify all the tasks, not just from the current one
+        self.status = "queued"  # queued, running, done, failed
+        self.result = None
+        self.error = None
+        self.created = datetime.datetime.utcnow()
+        self.started = None
+        self.finished = None
+        self.triggers = 1  # number of submits coalesced into this job
+        self.queued = None  # time.monotonic() when it joined the queue
+        self._finished = threading.Event()
+
+        # the progress of the verification, as dicts with type and data.
+        # The last event is "done" or "failed", with the job as the data.
+        self.events = []
+        self._changed = threading.Condition()
+
+    def is_finished(self):
+        return self.status in ["done", "failed"]
+
+    def add_event(self, type, data):
+        with self._changed:
+            self.events.append({"type": type, "data": data})
+            self._changed.notify_all()
+
+    def mark_finished(self, status):
+        with self._changed:
+            self.status = status
+            self.finished = datetime.datetime.utcnow()
+            self.add_event(status, self.dict())
+        self._finished.set()
+
+    def iter_events(self, start=0, timeout=15):
+        """Yields the events of the job from the index start, as (index,
+        event) pairs, waiting for the new ones till the job is finished.
+
+        None is yielded when there is no event for timeout seconds, for
+        the caller to keep the connection alive.
+        """
+        i = start
+        while True:
+            with self._changed:
+                if i >= len(self.events) and not self.is_finished():
+                    self._changed.wait(timeout)
+                events = self.events[i:]
+                finished = self.is_finished()
+            if events:
+                for event in events:
+                    yield i, event
+                    i += 1
+            elif finished:
+                return
+            else:
+                yield None
+
+    def wait(self, timeout=None):
+        """Waits till the job is finished or the timeout expires. Returns
+        True if the job is finished.
+        """
+        return self._finished.wait(timeout)
+
+    def dict(self):
+        def isoformat(t):
+            return t and t.isoformat()
+
+        return {
+            "id": self.id,
+            "app": self.app_name,
+            "status": self.status,
+            "priority": self.priority,
+            "full": self.full,
+            "result": self.result,
+            "error": self.error,
+            "created": isoformat(self.created),
+            "started": isoformat(self.started),
+            "finished": isoformat(self.finished),
+            "triggers": self.triggers,
+        }
+
+
+class JobQueue:
+    """Queue of verification jobs run by a pool of worker threads.
+
+    The jobs waiting to run are kept in a queue for each priority, in the
+    order they become ready to run, and the workers take the jobs of the
+    higher priority first. As an app has at most one job waiting and its
+    next job joins the end of the queue only after the current one is
+    finished, the apps get their turns in a round-robin order.
+    """
+    def __init__(self, workers, max_jobs=1000):
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._threads = []
+
+        # the job that is running and the job that is waiting to run, for
+        # each app. The waiting job joins the queue only after the running
+        # one is finished.
+        self._running = {}
+        self._pending = {}
+
+        # the jobs ready to run, for each priority
+        self._queues = {priority: deque() for priority in PRIORITIES}
+
+    def submit(self, app_name, priority=INTERACTIVE, full=False):
+        """Submits a job to verify the app and returns the job.
+
+        If a job of the app is already waiting to run, that job is
+        returned instead of creating a new one. Its priority is raised
+        if this one is higher and it verifies all the tasks if either of
+        them does.
+        """
+        key = app_name.lower()
+        with self._lock:
+            job = self._pending.get(key)
+            if job:
+                job.triggers += 1
+                job.full = job.full or full
+                if PRIORITIES.index(priority) < PRIORITIES.index(job.priority):
+                    self._raise_priority(job, priority)
+                return job
+
+            job = self._pending[key] = Job(app_name, priority, full)
+            self.jobs[job.id] = job
+            self._forget_old_jobs()
+            if key not in self._running:
+                self._enqueue(job)
+            # otherwise it is queued after the running job is finished
+        return job
+
+    def _raise_priority(self, job, priority):
+        queue = self._queues[job.priority]
+        if job in queue:
+            queue.remove(job)
+            job.priority = priority
+            self._enqueue(job)
+        else:
+            job.priority = priority
+
+    def _enqueue(self, job):
+        # must be called with the lock held
+        job.queued = time.monotonic()
+        self._queues[job.priority].append(job)
+        self._update_queue_depth()
+        self._start_workers()
+        self._ready.notify()
+
+    def _dequeue(self):
+        # must be called with the lock held
+        for priority in PRIORITIES:
+            if self._queues[priority]:
+                job = self._queues[priority].popleft()
+                self._update_queue_depth()
+                return job
+
+    def _update_queue_depth(self):
+        for priority in PRIORITIES:
+            metrics.job_queue_depth.set(len(self._queues[priority]), priority=priority)
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            t = threading.Thread(
+                target=self._work,
+                name=f"verifier-{len(self._threads)}",
+                daemon=True)
+            self._threads.append(t)
+            t.start()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                job = self._dequeue()
+                while job is None:
+                    self._ready.wait()
+                    job = self._dequeue()
+            self._run(job)
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def find_active(self, app_name):
+        """Returns the unfinished job of the app, if there is one.
+        """
+        key = app_name.lower()
+        with self._lock:
+            return self._pending.get(key) or self._running.get(key)
+
+    def update_metrics(self):
+        # the metrics of this queue are updated as the jobs move
+        pass
+
+    def _forget_old_jobs(self):
+        excess = len(self.jobs) - self.max_jobs
+        if excess <= 0:
+            return
+        finished = [job_id for job_id, job in self.jobs.items() if job.is_finished()]
+        for job_id in finished[:excess]:
+            del self.jobs[job_id]
+
+    def _run(self, job):
+        key = job.app_name.lower()
+        with self._lock:
+            del self._pending[key]
+            self._running[key] = job
+            metrics.jobs_running.set(len(self._running))
+
+        metrics.job_wait.observe(time.monotonic() - job.queued, priority=job.priority)
+        job.status = "running"
+        job.started = datetime.datetime.utcnow()
+        try:
+            job.result = verify_app(job.app_name, full=job.full, on_event=job.add_event)
+            status = "done"
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            status = "failed"
+        job.mark_finished(status)
+
+        with self._lock:
+            del self._running[key]
+            metrics.jobs_running.set(len(self._running))
+            trailing = self._pending.get(key)
+            if trailing:
+                self._enqueue(trailing)
+
+
+class DBJob(Job):
+    """A verification job saved in the job table.
+
+    The jobs in the table are run by the worker processes (worker.py). A
+    worker holds a lease on the job it is running and renews it every few
+    seconds. When a worker dies, its lease expires and another worker
+    takes the job over.
+    """
+    def __init__(self, row):
+        self.id = row.id
+        self.app_name = row.app_name
+        self.priority = PRIORITIES[row.priority]
+        self.full = bool(row.full)
+        self.status = row.status
+        self.result = row.result and json.loads(row.result)
+        self.error = row.error
+        self.created = parse_timestamp(row.created)
+        self.started = parse_timestamp(row.started)
+        self.finished = parse_timestamp(row.finished)
+        self.triggers = row.triggers
+        self.attempts = row.attempts
+        self.worker = row.worker
+        self._next_seq = None
+        self._events_lock = threading.Lock()
+
+    def wait(self, timeout=None, interval=0.5):
+        """Waits till the job is finished or the timeout expires. Returns
+        True if the job is finished.
+        """
+        deadline = timeout is not None and time.monotonic() + timeout
+        while not self.is_finished():
+            if deadline and time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+            self.__dict__.update(DBJob.find(self.id).__dict__)
+        return True
+
+    def add_event(self, type, data):
+        """Saves an event of the job, for iter_events to stream it from
+        the other processes. Called by the worker running the job.
+        """
+        with self._events_lock:
+            if self._next_seq is None:
+                # continue after the events of the earlier attempts
+                row = db.query("SELECT max(seq) AS seq FROM job_event WHERE job_id=$id",
+                               vars={"id": self.id}).first()
+                self._next_seq = 0 if row.seq is None else row.seq + 1
+            self._save_event(self._next_seq, type, data)
+            self._next_seq += 1
+
+    @writes
+    def _save_event(self, seq, type, data):
+        db.insert("job_event", job_id=self.id, seq=seq, type=type, data=json.dumps(data))
+
+    def iter_events(self, start=0, timeout=15, interval=1):
+        """Yields the events saved by the worker from the index start, as
+        (index, event) pairs, polling for the new ones till the job is
+        finished. The last event is "done" or "failed", with the job.
+
+        None is yielded when there is no event for timeout seconds, for
+        the caller to keep the connection alive.
+        """
+        i = start
+        last_yield = time.monotonic()
+        while True:
+            # the worker saves all the events before finishing the job
+            finished = self.is_finished()
+            rows = db.select("job_event",
+                where="job_id=$id AND seq >= $seq",
+                vars={"id": self.id, "seq": i},
+                order="seq").list()
+            for row in rows:
+                yield row.seq, {"type": row.type, "data": json.loads(row.data)}
+                i = row.seq + 1
+                last_yield = time.monotonic()
+            if finished:
+                break
+
+            time.sleep(interval)
+            self.__dict__.update(DBJob.find(self.id).__dict__)
+            if time.monotonic() - last_yield >= timeout:
+                last_yield = time.monotonic()
+                yield None
+
+        row = db.query("SELECT count(*) AS count FROM job_event WHERE job_id=$id",
+                       vars={"id": self.id}).first()
+        if row.count >= start:
+            yield row.count, {"type": self.status, "data": self.dict()}
+
+    @classmethod
+    def find(cls, job_id):
+        row = db.select("job", where="id=$id", vars={"id": job_id}).first()
+        return row and cls(row)
+
+    @classmethod
+    def find_active(cls, app_name):
+        """Returns the unfinished job of the app, the queued one first.
+        """
+        row = db.select("job",
+            where="lower(app_name)=lower($app_name) AND status IN ('queued', 'running')",
+            vars={"app_name": app_name},
+            order="status",
+            limit=1).first()
+        return row and cls(row)
+
+    @classmethod
+    @writes
+    def submit(cls, app_name, priority=INTERACTIVE, full=False):
+        """Adds a job to verify the app, unless there is a job of the app
+        waiting to run already, and returns the job.
+        """
+        priority = PRIORITIES.index(priority)
+        with db.transaction():
+            row = db.select("job",
+                where="lower(app_name)=lower($app_name) AND status='queued'",
+                vars={"app_name": app_name},
+                limit=1).first()
+            if row:
+                db.update("job",
+                    where="id=$id",
+                    vars={"id": row.id},
+                    triggers=web.SQLLiteral("triggers + 1"),
+                    priority=min(priority, row.priority),
+                    full=row.full or full)
+                return cls.find(row.id)
+
+            job_id = uuid.uuid4().hex
+            db.insert("job",
+                id=job_id,
+                app_name=app_name,
+                priority=priority,
+                full=full,
+                status="queued",
+                queued=time.time())
+            return cls.find(job_id)
+
+    @classmethod
+    @writes
+    def claim(cls, worker, lease):
+        """Claims the next job to run for the worker, with a lease of the
+        given number of seconds, and returns it. Returns None if there is
+        no job to run.
+
+        A queued job is claimed only if no other job of the same app is
+        running. A running job whose lease has expired is claimed again.
+        """
+        now = time.time()
+        count = db.query("""
+            UPDATE job SET
+                status='running',
+                worker=$worker,
+                lease_expires=$lease_expires,
+                attempts=attempts + 1,
+                started=CURRENT_TIMESTAMP
+            WHERE id = (
+                SELECT id FROM job j
+                WHERE (j.status='queued' AND NOT EXISTS (
+                        SELECT 1 FROM job r
+                        WHERE r.status='running' AND lower(r.app_name)=lower(j.app_name)))
+                   OR (j.status='running' AND j.lease_expires < $now)
+                ORDER BY j.priority, j.queued
+                LIMIT 1)
+            """, vars={"worker": worker, "lease_expires": now + lease, "now": now})
+        if count:
+            row = db.select("job",
+                where="worker=$worker AND status='running'",
+                vars={"worker": worker},
+                order="started desc",
+                limit=1).first()
+            return cls(row)
+
+    @writes
+    def renew(self, lease):
+        """Extends the lease of the job, if the worker still holds it.
+        Returns False if the job is taken over by another worker.
+        """
+        count = db.update("job",
+            where="id=$id AND worker=$worker AND status='running'",
+            vars={"id": self.id, "worker": self.worker},
+            lease_expires=time.time() + lease)
+        return bool(count)
+
+    @writes
+    def finish(self, app, status):
+        """Saves the status of the app and marks the job as done, in a
+        single transaction. Nothing is saved if the job has been taken
+        over by another worker.
+        """
+        with db.transaction():
+            if not self._end("done", result=json.dumps(status)):
+                return False
+            app.update_status(status)
+            return True
+
+    @writes
+    def fail(self, error, max_attempts):
+        """Marks the job as failed, or as queued to be retried if it has
+        been attempted less than max_attempts times.
+        """
+        if self.attempts < max_attempts:
+            return self._end("queued", error=error, finished=None)
+        return self._end("failed", error=error)
+
+    def _end(self, status, **kwargs):
+        kwargs.setdefault("finished", web.SQLLiteral("CURRENT_TIMESTAMP"))
+        count = db.update("job",
+            where="id=$id AND worker=$worker AND status='running'",
+            vars={"id": self.id, "worker": self.worker},
+            status=status,
+            lease_expires=None,
+            **kwargs)
+        if count and status != "queued":
+            # the next job of the app goes to the end of the queue, for
+            # the other apps to get their turn
+            db.update("job",
+                where="lower(app_name)=lower($app_name) AND status='queued'",
+                vars={"app_name": self.app_name},
+                queued=time.time())
+        return bool(count)
+
+    @staticmethod
+    @writes
+    def prune(days):
+        """Deletes the finished jobs older than the given number of days,
+        with their events.
+        """
+        where = "status IN ('done', 'failed') AND finished < $cutoff"
+        vars = {"cutoff": get_cutoff_timestamp(days)}
+        with db.transaction():
+            db.query(f"DELETE FROM job_event WHERE job_id IN (SELECT id FROM job WHERE {where})", vars=vars)
+            db.delete("job", where=where, vars=vars)
+
+
+class DBJobQueue:
+    """Queue of the verification jobs in the job table, run by the worker
+    processes.
+    """
+    def submit(self, app_name, priority=INTERACTIVE, full=False):
+        return DBJob.submit(app_name, priority, full)
+
+    def get(self, job_id):
+        return DBJob.find(job_id)
+
+    def find_active(self, app_name):
+        return DBJob.find_active(app_name)
+
+    def update_metrics(self):
+        rows = db.query("SELECT priority, count(*) AS count FROM job"
+                        " WHERE status='queued' GROUP BY priority")
+        counts = {PRIORITIES[row.priority]: row.count for row in rows}
+        for priority in PRIORITIES:
+            metrics.job_queue_depth.set(counts.get(priority, 0), priority=priority)
+        count = db.query("SELECT count(*) AS count FROM job WHERE status='running'").first().count
+        metrics.jobs_running.set(count)
+
+
+def parse_timestamp(timestamp):
+    return timestamp and datetime.datetime.fromisoformat(timestamp)
+
+
+def verify_app(name, full=False, on_event=None):
+    """Verifies the site of the app and saves the status in the db.
+    """
+    app = App.find(name)
+    status = get_app_status(app, full=full, on_event=on_event)
+    app.update_status(status)
+    return status
+
+
+def get_app_status(app, full=False, on_event=None):
+    """Verifies the site of the app and returns the status.
+
+    Unless full is True, the verification starts from the current task
+    of the app when nothing has changed on the site since the last time.
+    on_event, when given, is called with the type and the data of every
+    check and task as they are completed.
+    """
+    site = Site(app.name)
+    site.on_event = on_event
+    with site.memoize():
+        fingerprint = site.get_fingerprint()
+
+        start_at = None
+        if not full and config.INCREMENTAL and app.can_resume(fingerprint, config.FULL_CHECK_INTERVAL):
+            start_at = app.current_task
+
+        status = site.get_status(start_at=start_at)
+    status["fingerprint"] = fingerprint
+    return status
+
+
+if config.JOB_QUEUE == "db":
+    queue = DBJobQueue()
+else:
+    queue = JobQueue(workers=config.WORKERS, max_jobs=config.MAX_JOBS)
@@ -0,0 +1,192 @@
+"""Metrics of the verification, exported in the Prometheus text format.
+
+The metrics are kept in the memory of the process and are exported by
+the /metrics endpoint of the app. The worker processes, which run the
+checks, export theirs with serve(). Updating a metric takes a lock and a
+dict lookup, cheap enough to be left on in production.
+"""
+import contextlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key, value):
+        return [f"{self.name}{format_labels(self.labels, key)} {value}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # a count for every bucket, followed by the sum and the count
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes the time taken by the with block.
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def render_value(self, key, counts):
+        lines = []
+        for bound, count in zip(self.buckets, counts):
+            labels = format_labels(self.labels, key, ("le", bound))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+        labels = format_labels(self.labels, key, ("le", "+Inf"))
+        lines.append(f"{self.name}_bucket{labels} {counts[-1]}")
+        labels = format_labels(self.labels, key)
+        lines.append(f"{self.name}_sum{labels} {counts[-2]}")
+        lines.append(f"{self.name}_count{labels} {counts[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host=""):
+    """Exports the metrics of this process at http://host:port/metrics,
+    from a background thread. Returns the server.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+check_duration = REGISTRY.histogram(
+    "rajdhani_check_duration_seconds", "Time taken by Check.validate", ["check"])
+check_results = REGISTRY.counter(
+    "rajdhani_check_results_total", "Number of checks by the result", ["check", "status"])
+
+task_duration = REGISTRY.histogram(
+    "rajdhani_task_duration_seconds", "Time taken by Task.verify", ["task"])
+task_results = REGISTRY.counter(
+    "rajdhani_task_results_total", "Number of task verifications by the result", ["task", "status"])
+
+http_duration = REGISTRY.histogram(
+    "rajdhani_http_request_duration_seconds", "Latency of the requests to the sites", ["method", "site"])
+http_requests = REGISTRY.counter(
+    "rajdhani_http_requests_total", "Number of requests to the sites by the response status",
+    ["method", "site", "status"])
+site_unreachable = REGISTRY.counter(
+    "rajdhani_site_unreachable_total",
+    "Number of verifications cut short or skipped as the site was not responding", ["site"])
+
+job_queue_depth = REGISTRY.gauge(
+    "rajdhani_job_queue_depth", "Number of verification jobs waiting to run", ["priority"])
+job_wait = REGISTRY.histogram(
+    "rajdhani_job_wait_seconds", "Time the verification jobs waited to run", ["priority"])
+jobs_running = REGISTRY.gauge(
+    "rajdhani_jobs_running", "Number of verification jobs running")
+
+db_write_duration = REGISTRY.histogram(
+    "rajdhani_db_write_duration_seconds", "Time taken by the writes to the database", ["operation"])
@@ -0,0 +1,167 @@
+"""Schema migrations for the rajdhani database.
+
+The schema.sql always has the latest schema and a new database is
+created from it. An existing database is upgraded in place by applying
+the migrations that are newer than its version:
+
+    $ python migrate.py
+
+The version of the database is maintained in the schema_version table.
+A database without that table is at version 0, the original schema.
+
+To change the schema, update schema.sql, add a migration at the end of
+MIGRATIONS and update the version inserted at the end of schema.sql.
+"""
+import config
+from db import db, get_cutoff_timestamp
+
+# number of rows deleted in one query, below the limit of 999 variables
+# in a query of the older sqlite versions
+DELETE_CHUNK_SIZE = 500
+
+
+def has_column(table, column):
+    rows = db.query(f"PRAGMA table_info({table})")
+    return any(row.name == column for row in rows)
+
+
+def add_column(table, column, type):
+    if not has_column(table, column):
+        db.query(f"ALTER TABLE {table} ADD COLUMN {column} {type}")
+
+
+def migrate_incremental_verification():
+    add_column("app", "fingerprint", "text")
+    add_column("app", "last_full_check", "text")
+
+
+def migrate_unique_task():
+    # keep only the latest row when there are duplicate rows for a task
+    db.query("""
+        DELETE FROM task WHERE id NOT IN (
+            SELECT max(id) FROM task GROUP BY app_id, name
+        )""")
+    db.query("CREATE UNIQUE INDEX IF NOT EXISTS task_app_name ON task(app_id, name)")
+
+    # the score counted the duplicate rows of the passed tasks
+    db.query("""
+        UPDATE app SET score=(
+            SELECT count(*) FROM task WHERE task.app_id=app.id AND status='pass'
+        )""")
+
+
+def migrate_indexes():
+    db.query("CREATE INDEX IF NOT EXISTS app_lower_name ON app(lower(name))")
+    db.query("CREATE INDEX IF NOT EXISTS changelog_app_timestamp ON changelog(app_id, timestamp)")
+
+
+def migrate_changelog_compaction():
+    add_column("changelog", "count", "int default 1")
+    add_column("changelog", "first_timestamp", "text")
+
+    if config.CHANGELOG_RETENTION_DAYS:
+        db.delete("changelog",
+            where="timestamp < $cutoff",
+            vars={"cutoff": get_cutoff_timestamp(config.CHANGELOG_RETENTION_DAYS)})
+
+    # collapse the consecutive deploy entries of each app into the last one
+    rows = db.select("changelog", order="app_id, timestamp, id").list()
+    group, group_key = [], None
+    for row in rows:
+        key = (row.app_id, row.type, row.message)
+        if key != group_key:
+            compact_changelog(group)
+            group, group_key = [], key
+        if row.type == "deploy":
+            group.append(row)
+    compact_changelog(group)
+
+
+def compact_changelog(entries):
+    if len(entries) < 2:
+        return
+    first, last = entries[0], entries[-1]
+    db.update("changelog",
+        where="id=$id",
+        vars={"id": last.id},
+        count=len(entries),
+        first_timestamp=first.timestamp)
+    # an app can have thousands of entries to delete, more than the number
+    # of variables allowed in a query
+    ids = [e.id for e in entries[:-1]]
+    for i in range(0, len(ids), DELETE_CHUNK_SIZE):
+        db.delete("changelog", where="id IN $ids", vars={"ids": ids[i:i+DELETE_CHUNK_SIZE]})
+
+
+def migrate_job_table():
+    db.query("""
+        CREATE TABLE IF NOT EXISTS job (
+            id text primary key,
+            app_name text,
+            priority int,
+            status text,
+            queued real,
+            triggers int default 1,
+            attempts int default 0,
+            worker text,
+            lease_expires real,
+            result text,
+            error text,
+            created text default CURRENT_TIMESTAMP,
+            started text,
+            finished text
+        )""")
+    db.query("CREATE INDEX IF NOT EXISTS job_status_priority ON job(status, priority, queued)")
+    db.query("CREATE INDEX IF NOT EXISTS job_app_status ON job(lower(app_name), status)")
+
+
+def migrate_job_full():
+    add_column("job", "full", "int default 0")
+
+
+def migrate_job_event_table():
+    db.query("""
+        CREATE TABLE IF NOT EXISTS job_event (
+            job_id text,
+            seq int,
+            type text,
+            data text,
+            primary key (job_id, seq)
+        )""")
+
+
+MIGRATIONS = [
+    (1, migrate_incremental_verification),
+    (2, migrate_unique_task),
+    (3, migrate_indexes),
+    (4, migrate_changelog_compaction),
+    (5, migrate_job_table),
+    (6, migrate_job_full),
+    (7, migrate_job_event_table),
+]
+
+
+def get_version():
+    db.query("CREATE TABLE IF NOT EXISTS schema_version ("
+             " version int primary key,"
+             " applied text default CURRENT_TIMESTAMP)")
+    row = db.query("SELECT max(version) AS version FROM schema_version").first()
+    return row.version or 0
+
+
+def migrate():
+    """Applies all the pending migrations, each in its own transaction.
+    """
+    version = get_version()
+    for v, func in MIGRATIONS:
+        if v <= version:
+            continue
+        print(f"Applying migration {v}: {func.__name__}")
+        with db.transaction():
+            func()
+            db.insert("schema_version", version=v)
+    print(f"The database is at version {max(version, MIGRATIONS[-1][0])}")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,129 @@
+"""Re-verifies the sites of all the apps and updates their status.
+
+This is required whenever the tasks or the checks are changed.
+
+The apps are verified as background jobs in the same queue as the
+deploys, so the jobs are run by the workers and each job saves the status
+of its app. The command gives up waiting when the jobs are not being
+run, as when no worker is running, and reports the jobs left.
+
+Usage:
+
+    $ python rescore.py [--timeout SECONDS] [app-name ...]
+"""
+import argparse
+import time
+from collections import Counter
+
+import jobs
+from db import App
+
+# seconds between the checks of the status of the jobs
+POLL_INTERVAL = 1
+
+
+def verify_all(apps, timeout):
+    """Verifies all the tasks of the given apps as background jobs and
+    waits for them to finish.
+
+    The waiting stops when no job has been running or finished for
+    timeout seconds.
+
+    Returns the list of (app, status) for the apps that are verified, the
+    list of (app, error) for the apps that couldn't be and the list of
+    (app, job) for the jobs that are not finished.
+    """
+    pending = [(app, jobs.queue.submit(app.name, priority=jobs.BACKGROUND, full=True))
+               for app in apps]
+    print(f"Submitted {len(pending)} jobs, waiting for the workers to run them")
+
+    results = []
+    errors = []
+    last_progress = time.monotonic()
+    while pending:
+        time.sleep(POLL_INTERVAL)
+        # the jobs of the memory queue are updated in place, the finished
+        # ones may have been forgotten by the queue
+        pending = [(app, jobs.queue.get(job.id) or job) for app, job in pending]
+        for app, job in pending:
+            if job.status == "done":
+                results.append((app, job.result))
+            elif job.status == "failed":
+                errors.append((app, job.error))
+
+        unfinished = [(app, job) for app, job in pending if not job.is_finished()]
+        if len(unfinished) < len(pending) or any(job.status == "running" for app, job in unfinished):
+            last_progress = time.monotonic()
+        pending = unfinished
+
+        if pending and time.monotonic() - last_progress > timeout:
+            break
+    return results, errors, pending
+
+
+def print_summary(results, errors, unfinished, verify_time):
+    n = len(results) + len(errors)
+    throughput = n / verify_time if verify_time else 0
+
+    print()
+    print(f"Verified {n} apps in {verify_time:.1f}s ({throughput:.2f} apps/sec)")
+
+    current_tasks = Counter(status["current_task"] for app, status in results
+                            if not status.get("unreachable"))
+    print()
+    print("Apps by current task:")
+    for task_name, count in current_tasks.most_common():
+        print(f"  {task_name:40} {count}")
+
+    def has_errors(status):
+        return any(check["status"] == "error"
+                   for task_status in status["tasks"].values()
+                   for check in task_status["checks"])
+
+    unreachable = [app for app, status in results if status.get("unreachable")]
+    if unreachable:
+        print()
+        print(f"Sites not responding for {len(unreachable)} apps:")
+        print("  " + " ".join(app.name for app in unreachable))
+
+    broken = [app for app, status in results if has_errors(status)]
+    if broken:
+        print()
+        print(f"Checks errored for {len(broken)} apps:")
+        print("  " + " ".join(app.name for app in broken))
+
+    if errors:
+        print()
+        print(f"Failed to verify {len(errors)} apps:")
+        for app, error in errors:
+            print(f"  {app.name}: {error}")
+
+    if unfinished:
+        print()
+        print(f"Gave up waiting for {len(unfinished)} jobs that were not run."
+              " Is worker.py running?")
+        for app, job in unfinished:
+            print(f"  {app.name}: job {job.id} is {job.status}")
+
+
+def main():
+    p = argparse.ArgumentParser(description="Re-verify the sites of all the apps")
+    p.add_argument("--timeout", type=float, default=60,
+                   help="seconds to wait while no job is running or finishing (default: 60)")
+    p.add_argument("apps", nargs="*", help="names of the apps to verify (default: all)")
+    args = p.parse_args()
+
+    apps = App.find_all()
+    if args.apps:
+        names = {name.lower() for name in args.apps}
+        apps = [app for app in apps if app.name.lower() in names]
+
+    t0 = time.time()
+    results, errors, unfinished = verify_all(apps, timeout=args.timeout)
+    t1 = time.time()
+
+    print_summary(results, errors, unfinished, verify_time=t1-t0)
+
+
+if __name__ == "__main__":
+    main()
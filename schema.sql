@@ -4,10 +4,15 @@ create table app (
     current_task text,
     score int,
     healthy int default 1,
+    -- sha1 of /api/flags at the last verification
+    fingerprint text,
+    last_full_check text,
     created text default CURRENT_TIMESTAMP,
     last_updated text default CURRENT_TIMESTAMP
 );
 
+create index app_lower_name on app(lower(name));
+
 -- the completed_tasks table maintains the list of tasks that are
 -- completed for each app. When a completed task is broken due to
 -- a subsequent change, it is marked as broken.
@@ -17,10 +22,10 @@ create table task (
     name text,
     status text, -- completed, broken, pending
     checks text,
-    timestamp text default CURRENT_TIMESTAMP
+    timestamp text default CURRENT_TIMESTAMP,
+    unique (app_id, name)
 );
 
-
 -- changelog maintains all the changes to an app
 -- entries could be one of the following types
 --   deployed
@@ -33,5 +38,54 @@ create table changelog (
     app_id integer references app(id),
     timestamp text default CURRENT_TIMESTAMP,
     type text,
-    message text
+    message text,
+    -- consecutive deploy entries are collapsed into one, with the number
+    -- of deploys and the time of the first one
+    count int default 1,
+    first_timestamp text
+);
+
+create index changelog_app_timestamp on changelog(app_id, timestamp);
+
+-- verification jobs, unless RAJDHANI_JOB_QUEUE=memory. The worker running a job
+-- holds a lease on it till lease_expires (unix time) and renews it while
+-- the job is running. A job with an expired lease is taken over by
+-- another worker.
+create table job (
+    id text primary key,
+    app_name text,
+    priority int,       -- 0 interactive, 1 background
+    full int default 0, -- 1 to verify all the tasks, not just from the current one
+    status text,        -- queued, running, done, failed
+    queued real,        -- unix time when it joined the queue
+    triggers int default 1,
+    attempts int default 0,
+    worker text,
+    lease_expires real,
+    result text,
+    error text,
+    created text default CURRENT_TIMESTAMP,
+    started text,
+    finished text
+);
+
+create index job_status_priority on job(status, priority, queued);
+create index job_app_status on job(lower(app_name), status);
+
+-- the progress of the jobs, saved by the workers and streamed to the app
+-- page. seq is the index of the event in the job.
+create table job_event (
+    job_id text,
+    seq int,
+    type text,
+    data text, -- json
+    primary key (job_id, seq)
+);
+
+-- version of the schema, used by migrate.py to upgrade existing databases.
+-- Update the version here when adding a new migration.
+create table schema_version (
+    version int primary key,
+    applied text default CURRENT_TIMESTAMP
 );
+insert into schema_version (version) values (7);
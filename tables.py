@@ -0,0 +1,97 @@
+"""Extracting tables from the html pages of the sites.
+
+The /data-explorer and /trains/<n> pages are parsed to find the rows of
+the first table in them. Instead of building the whole document tree,
+the html is fed to the lxml parser in chunks with a target that collects
+only the text of the cells, and the parsing stops at the end of the
+first table.
+"""
+from lxml import etree
+
+CHUNK_SIZE = 16 * 1024
+
+# version of the extraction, part of the key of the cached results. Change
+# it when a fix changes the rows extracted from a page.
+VERSION = 1
+
+
+class TableTarget:
+    """lxml parser target that collects the rows of the first table.
+
+    The text of a cell includes the text of all the elements inside it,
+    like the text of the cell in BeautifulSoup. The rows of the tables
+    nested inside the first table are not collected.
+    """
+    def __init__(self):
+        self.rows = []
+        self.found = False
+        self.done = False
+        self.depth = 0  # depth of the nested tables
+        self.row = None
+        self.cell = None
+
+    def start(self, tag, attrib):
+        if self.done:
+            return
+        if tag == "table":
+            self.found = True
+            self.depth += 1
+        elif self.depth != 1:
+            return
+        elif tag == "tr":
+            self.row = []
+        elif tag in ("td", "th") and self.row is not None:
+            self.cell = []
+
+    def end(self, tag):
+        if self.done or self.depth == 0:
+            return
+        if tag == "table":
+            self.depth -= 1
+            self.done = self.depth == 0
+        elif self.depth != 1:
+            return
+        elif tag in ("td", "th") and self.cell is not None:
+            self.row.append("".join(self.cell).strip())
+            self.cell = None
+        elif tag == "tr" and self.row is not None:
+            self.rows.append(self.row)
+            self.row = None
+
+    def data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+
+    def close(self):
+        return self.rows
+
+
+def iter_table_rows(html):
+    """Yields the rows of the first table in the html, each row as a list
+    of strings.
+
+    Raises ValueError if there is no table in the html.
+    """
+    target = TableTarget()
+    parser = etree.HTMLParser(target=target)
+    for i in range(0, len(html), CHUNK_SIZE):
+        parser.feed(html[i:i+CHUNK_SIZE])
+        yield from target.rows
+        target.rows = []
+        if target.done:
+            return
+
+    try:
+        parser.close()
+    except etree.XMLSyntaxError:
+        # raised for an empty document
+        pass
+    yield from target.rows
+    if not target.found:
+        raise ValueError("No table found in the html")
+
+
+def extract_table(html):
+    """Returns the rows of the first table in the html.
+    """
+    return list(iter_table_rows(html))
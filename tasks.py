@@ -1,22 +1,42 @@
 from __future__ import annotations
-from cmath import exp
-import requests
-import yaml
 from dataclasses import dataclass, asdict
 from collections import namedtuple
 from typing import List
-from bs4 import BeautifulSoup
-from email.parser import Parser as EmailParser
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import contextlib
-
-from hamr import HamrError, hamr
+import hashlib
+import itertools
+import json
+import threading
+import time
+
+import config
+import httpcache
+import metrics
+from catalog import Catalog
+import transport
+
+# The modules required only for verifying the sites (requests, bs4, yaml,
+# hamr etc.) are imported in the functions that use them, to keep the
+# import of this module cheap for the read-only pages of the app.
 
 DOMAIN = "rajdhani.pipal.in"
-MAIL_FILE = "rajdhani.mail"
 
 HamrResponse = namedtuple("HamrResponse", ["ok", "message"])
 
+_site_limits = {}
+_site_limits_lock = threading.Lock()
+
+def get_site_limit(domain):
+    """Returns the semaphore bounding the requests in flight to a domain.
+
+    It is shared by all the Site objects of the same domain.
+    """
+    with _site_limits_lock:
+        if domain not in _site_limits:
+            _site_limits[domain] = threading.BoundedSemaphore(config.SITE_CONCURRENCY)
+        return _site_limits[domain]
+
 
 class Site:
     def __init__(self, name):
@@ -28,7 +48,28 @@ class Site:
             self.domain = f"{name}.{DOMAIN}"
             self.base_url = f"https://{self.domain}"
 
-        self.session = requests
+        self.shared_session = transport.get_session(self.domain)
+        self.session = self.shared_session
+        self.limit = get_site_limit(self.domain)
+        self.breaker = transport.get_breaker(self.domain)
+
+        # the time by which the verification and, for each thread, the
+        # current check must finish
+        self._run_deadline = None
+        self._check_deadline = threading.local()
+
+        # called with the type and the data of every event in the progress
+        # of the verification, like a check or a task being completed
+        self.on_event = None
+
+        # events of the tasks verified ahead, held back till the task is
+        # reached
+        self._held_events = {}
+        self._events_lock = threading.Lock()
+
+        # responses of the GET requests, cached when memoizing
+        self._responses = None
+        self._responses_lock = threading.Lock()
 
     def _get_headers(self):
         return {
@@ -36,6 +77,8 @@ class Site:
         }
 
     def create(self, git_url=None):
+        from hamr import HamrError, hamr
+
         name = self.name
         if not git_url:
             git_url = f"https://github.com/{name}/rajdhani"
@@ -49,31 +92,213 @@ class Site:
 
     @contextlib.contextmanager
     def with_session(self):
-        with requests.Session() as sess:
+        """Uses a new session with its own cookies for all the requests
+        made in the with block.
+        """
+        with transport.new_session() as sess:
             self.session = sess
             try:
                 yield self.session
             finally:
-                self.session = requests
+                self.session = self.shared_session
+
+    @contextlib.contextmanager
+    def memoize(self):
+        """Caches the responses of the GET requests made in the with block.
+
+        A GET request to the same URL with the same params gets the same
+        response. Any POST request clears the cache. The requests made
+        with a session from with_session are never cached.
+        """
+        if self._responses is not None:
+            yield
+            return
+
+        self._responses = {}
+        try:
+            yield
+        finally:
+            self._responses = None
+
+    def emit(self, type, **data):
+        with self._events_lock:
+            held = self._held_events.get(data.get("task"))
+            if held is not None:
+                held.append((type, data))
+                return
+        if self.on_event:
+            self.on_event(type, data)
+
+    def _release_events(self, task_name):
+        """Emits the events held back for the task and lets its further
+        events through.
+        """
+        with self._events_lock:
+            for type, data in self._held_events.pop(task_name, []):
+                if self.on_event:
+                    self.on_event(type, data)
+
+    @contextlib.contextmanager
+    def budget(self, seconds):
+        """Limits the time of the verification in the with block to the
+        given number of seconds. There is no limit if seconds is 0.
+        """
+        self._run_deadline = seconds and time.monotonic() + seconds or None
+        try:
+            yield
+        finally:
+            self._run_deadline = None
+
+    @contextlib.contextmanager
+    def check_budget(self, seconds):
+        """Limits the time of the check in the with block to the given
+        number of seconds. The limit applies only to the current thread.
+        """
+        self._check_deadline.value = seconds and time.monotonic() + seconds or None
+        try:
+            yield
+        finally:
+            self._check_deadline.value = None
+
+    def time_left(self):
+        """Returns the number of seconds left for the current check or the
+        verification, whichever ends first, or None if there is no limit.
+        """
+        deadlines = [d for d in (self._run_deadline, getattr(self._check_deadline, "value", None)) if d]
+        if not deadlines:
+            return None
+        return min(deadlines) - time.monotonic()
+
+    def _get_timeout(self, timeout):
+        """Returns the timeout for a request, cut short to the time left.
+        """
+        time_left = self.time_left()
+        if time_left is None:
+            return timeout
+        if time_left <= 0:
+            raise transport.DeadlineExceeded("Ran out of time for the verification of the site")
+        connect_timeout, read_timeout = timeout
+        return min(connect_timeout, time_left), min(read_timeout, time_left)
+
+    def _get_cache_key(self, url, kwargs):
+        """Returns the key to cache the response of a GET request, or None
+        if the response can not be cached.
+        """
+        if self.session is not self.shared_session:
+            return None
+        if set(kwargs) - {"params", "timeout"}:
+            return None
+        params = json.dumps(kwargs.get("params"), sort_keys=True, default=str)
+        return f"{url} {params}"
 
     def get(self, path, **kwargs):
         url = self.base_url.rstrip("/") + path
         headers = kwargs.pop("headers", {})
         headers.update(self._get_headers())
-        print("GET", url)
-        return self.session.get(url, headers=headers, **kwargs)
+        kwargs.setdefault("timeout", transport.TIMEOUT)
+
+        key = self._get_cache_key(url, kwargs)
+        memoize = key is not None and self._responses is not None
+        if memoize:
+            with self._responses_lock:
+                if key in self._responses:
+                    return self._responses[key]
+
+        entry = None
+        if key is not None and httpcache.cache:
+            entry = httpcache.cache.get("GET " + key)
+            headers.update(httpcache.get_cache_headers(entry))
+
+        response = self._request("GET", url, headers=headers, **kwargs)
+
+        if entry and response.status_code == 304:
+            response.from_cache = True
+            response.status_code = 200
+            response._content = entry["value"]
+            response.encoding = entry["encoding"]
+        elif key is not None and httpcache.cache and httpcache.is_cacheable(response):
+            httpcache.cache.put("GET " + key, response.content,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+                encoding=response.encoding)
+
+        if memoize:
+            with self._responses_lock:
+                self._responses[key] = response
+        return response
 
     def post(self, path, **kwargs):
         url = self.base_url.rstrip("/") + path
         headers = kwargs.pop("headers", {})
         headers.update(self._get_headers())
-        print("POST", url)
-        return self.session.post(url, headers=headers, **kwargs)
+        kwargs.setdefault("timeout", transport.TIMEOUT)
+        if self._responses is not None:
+            with self._responses_lock:
+                self._responses.clear()
+
+        return self._request("POST", url, headers=headers, **kwargs)
+
+    def _request(self, method, url, **kwargs):
+        """Makes the request, retrying the GET requests that fail to connect
+        or get an error from the proxy in front of the site.
+
+        Every retry gets only the time that is left for the check, and it
+        is not made when that is less than the wait before it.
+        """
+        from requests import ConnectionError, Timeout
+
+        print(method, url)
+        retry = 0
+        while True:
+            try:
+                response = self._send(method, url, **kwargs)
+            except (ConnectionError, Timeout):
+                if not self._wait_to_retry(method, retry + 1):
+                    self.breaker.record_failure()
+                    raise
+            else:
+                self.breaker.record_success()
+                if response.status_code not in transport.RETRY_STATUSES \
+                        or not self._wait_to_retry(method, retry + 1):
+                    return response
+                response.close()
+            retry += 1
+
+    def _wait_to_retry(self, method, retry):
+        """Waits before the given retry of the request and returns True, or
+        returns False if the request is not to be retried.
+        """
+        if method not in transport.RETRY_METHODS or retry > config.HTTP_RETRIES:
+            return False
+        backoff = transport.get_backoff(retry)
+        time_left = self.time_left()
+        if time_left is not None and time_left <= backoff:
+            return False
+        time.sleep(backoff)
+        return True
+
+    def _send(self, method, url, **kwargs):
+        if not self.breaker.allow():
+            raise transport.SiteUnavailable(f"The site {self.domain} is not responding")
+        kwargs["timeout"] = self._get_timeout(kwargs["timeout"])
+
+        status = "error"
+        with self.limit:
+            t0 = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+                status = response.status_code
+                return response
+            finally:
+                metrics.http_duration.observe(time.perf_counter() - t0, method=method, site=self.name)
+                metrics.http_requests.inc(method=method, site=self.name, status=status)
 
     def login(self, email):
         return self.get(f"/login?email={email}")
 
     def sync(self):
+        from hamr import HamrError
+
         try:
             #hamr.sync_app(self.name)
             pass
@@ -91,38 +316,123 @@ class Site:
         results = self.get("/api/stations", params={"q": prefix}).json()
         return [row['code'] for row in results]
 
-    def get_status(self):
+    def get_fingerprint(self):
+        """Returns a fingerprint of the site that changes when the flags
+        are changed, or None if the flags couldn't be fetched.
+        """
+        from requests import RequestException
+
+        try:
+            response = self.get("/api/flags")
+            response.raise_for_status()
+        except (RequestException, transport.SiteUnavailable, transport.DeadlineExceeded):
+            return None
+        return hashlib.sha1(response.content).hexdigest()
+
+    def get_status(self, start_at=None):
         """Runs the tests for each task and returns the status for each task.
+
+        When start_at is given, the tasks before that are skipped and are
+        assumed to be passing. The status has full=True only when all the
+        tasks are verified.
+
+        When the site stops responding, the verification is cut short and
+        the status has unreachable=True. The tasks in such a status are not
+        to be trusted.
         """
+        all_tasks = TASKS.tasks
+        names = [task.name for task in all_tasks]
+        index = names.index(start_at) if start_at in names else 0
+
+        if not self.breaker.allow():
+            metrics.site_unreachable.inc(site=self.name)
+            return dict(tasks={}, current_task=names[index], full=False, unreachable=True)
+
         tasks = {}
-        for task in TASKS:
-            task_status = task.verify(self)
-            tasks[task.name] = asdict(task_status)
-            if task_status.status != "pass":
-                break
-        return dict(tasks=tasks, current_task=task.name)
+        with self.memoize(), self.budget(config.RUN_TIMEOUT), \
+                contextlib.closing(self._verify_tasks(all_tasks[index:])) as results:
+            for task, task_status in results:
+                tasks[task.name] = asdict(task_status)
+                if task_status.status != "pass" or not self.breaker.allow():
+                    break
+
+        status = dict(tasks=tasks, current_task=task.name, full=index == 0)
+        if not self.breaker.allow():
+            metrics.site_unreachable.inc(site=self.name)
+            status["unreachable"] = True
+        return status
+
+    def _verify_tasks(self, tasks):
+        """Verifies the tasks and yields (task, task_status) for each of
+        them, in the order of the tasks.
+
+        In the speculative mode, the read-only tasks ahead of the current
+        one, up to the next task with side effects, are verified in
+        parallel. Their events are held back till the task is reached, so
+        nothing is seen of the tasks after the first failing one.
+        """
+        if not config.SPECULATIVE:
+            for task in tasks:
+                yield task, task.verify(self)
+            return
+
+        executor = ThreadPoolExecutor(
+            max_workers=config.TASK_CONCURRENCY,
+            thread_name_prefix="speculative")
+        futures = {}
+        try:
+            for i, task in enumerate(tasks):
+                if task.is_read_only and task not in futures:
+                    for ahead in itertools.takewhile(lambda t: t.is_read_only, tasks[i:]):
+                        with self._events_lock:
+                            self._held_events[ahead.name] = []
+                        futures[ahead] = executor.submit(ahead.verify, self)
+
+                if task in futures:
+                    self._release_events(task.name)
+                    yield task, futures[task].result()
+                else:
+                    yield task, task.verify(self)
+        finally:
+            # the tasks verified ahead are still using the site
+            executor.shutdown(wait=True, cancel_futures=True)
+            with self._events_lock:
+                self._held_events.clear()
 
     def query(self, sql):
         params = dict(q=sql)
         url = "/data-explorer"
-        html = self.get(url, params=params).text
-        table = self.extract_table(html)
+        response = self.get(url, params=params)
+        table = self.extract_table(response)
         columns = table[0]
         rows = table[1:]
 
         # skip the serial number column at positon 0
         return [dict(zip(columns[1:], row[1:])) for row in rows]
 
-    def extract_table(self, html):
-        soup = BeautifulSoup(html, "lxml")
-        table = soup.select("table")[0]
-        return self.parse_table(table)
+    def extract_table(self, response):
+        """Returns the rows of the first table in the html of the response
+        as lists of strings.
+
+        When the response can be validated, the result is cached using the
+        hash of the html, so an unchanged page is parsed only once.
+        """
+        import tables
 
-    def parse_table(self, table):
-        return [self.parse_row(tr) for tr in table.select("tr")]
+        html = response.text
+        key = None
+        if httpcache.cache and httpcache.is_validated(response):
+            h = hashlib.sha1(html.encode("utf-8")).hexdigest()
+            key = f"table v{tables.VERSION} {h}"
+            entry = httpcache.cache.get(key)
+            if entry:
+                return json.loads(entry["value"])
 
-    def parse_row(self, tr):
-        return [cell.text.strip() for cell in tr.select("th,td")]
+        rows = tables.extract_table(html)
+
+        if key:
+            httpcache.cache.put(key, json.dumps(rows).encode("utf-8"))
+        return rows
 
     def make_booking(self, train, ticket_class, date,
                      passenger_name, passenger_email):
@@ -160,13 +470,32 @@ class CheckFailed(Exception):
     pass
 
 class Check:
+    # checks with side effects on the site are marked sequential and they
+    # are run one after the other, in the order they are specified.
+    sequential = False
+
     def validate(self, site):
+        name = type(self).__name__
+        time_left = site.time_left()
+        if time_left is not None and time_left <= 0:
+            status = CheckStatus(self.title).error("Ran out of time for the verification of the site")
+            metrics.check_results.inc(check=name, status=status.status)
+            return status
+
+        with metrics.check_duration.time(check=name), site.check_budget(config.CHECK_TIMEOUT):
+            status = self._validate(site)
+        metrics.check_results.inc(check=name, status=status.status)
+        return status
+
+    def _validate(self, site):
         status = CheckStatus(self.title)
         try:
             self.do_validate(site)
             return status
         except CheckFailed as e:
             return status.fail(str(e))
+        except (transport.SiteUnavailable, transport.DeadlineExceeded) as e:
+            return status.error(str(e))
         except Exception as e:
             import traceback
             traceback.print_exc()
@@ -296,8 +625,7 @@ class check_schedule(Check):
 
 
     def do_validate(self, site):
-        html = site.get(f"/trains/{self.train}").text
-        schedule = site.extract_table(html)
+        schedule = site.extract_table(site.get(f"/trains/{self.train}"))
 
         for row in self.ensure_rows:
             if row not in schedule:
@@ -306,6 +634,8 @@ class check_schedule(Check):
 
 @register_check
 class check_booking(Check):
+    sequential = True
+
     def __init__(self, train_number, ticket_class, date,
                 from_station_code, to_station_code,
                  passenger_name, passenger_email):
@@ -372,6 +702,8 @@ class check_booking(Check):
 
 @register_check
 class check_ticket_confirmation_email(Check):
+    sequential = True
+
     def __init__(self, train, ticket_class, date,
                  passenger_name, passenger_email):
         self.train = train
@@ -382,20 +714,37 @@ class check_ticket_confirmation_email(Check):
 
         self.title = f"Check booking confirmation email -> Train {self.train}:{self.ticket_class}, Date {date}, Passenger: {passenger_name} ({passenger_email})"
 
+    def get_recipient(self, site):
+        """Returns the email address to book the ticket with.
+
+        The name of the site is added to the passenger_email as a +tag, so
+        that the emails from the sites verified at the same time don't get
+        mixed up.
+        """
+        user, domain = self.passenger_email.split("@", 1)
+        return f"{user}+{site.name}@{domain}"
+
     def do_validate(self, site):
+        recipient = self.get_recipient(site)
+        since = time.time()
         site.make_booking(train=self.train, ticket_class=self.ticket_class,
                           date=self.date, passenger_name=self.passenger_name,
-                          passenger_email=self.passenger_email)
+                          passenger_email=recipient)
 
-        email = get_last_email()
-        if not email or self.passenger_email not in email["X-RcptTo"]:
+        timeout = config.MAIL_TIMEOUT
+        if site.time_left() is not None:
+            timeout = max(0, min(timeout, site.time_left()))
+        email = wait_for_email(recipient, since=since, timeout=timeout)
+        if not email:
             raise CheckFailed(
-                f"Confirmation email not received for booking with email: {self.passenger_email}"
+                f"Confirmation email not received for booking with email: {recipient}"
             )
 
 
 @register_check
 class check_get_trips(Check):
+    sequential = True
+
     def __init__(self, bookings):
         """
         Each booking should be a dict of train, class, date
@@ -406,6 +755,8 @@ class check_get_trips(Check):
         self.passenger_email = "evaluator@example.com"
 
     def get_bookings_from_html(self, html):
+        from bs4 import BeautifulSoup
+
         soup = BeautifulSoup(html, "lxml")
         booking_cards = soup.find_all("div", class_="card")
         for card in booking_cards:
@@ -457,23 +808,61 @@ class Task:
         self.name = name
         self.title = title
         self.description = description
+        self.description_html = None
         self.checks = checks
 
+    @property
+    def is_read_only(self):
+        """Tells if the task can be verified without changing anything on
+        the site, that is, it has no sequential checks.
+        """
+        return not any(c.sequential for c in self.checks)
+
     def verify(self, site) -> TaskStatus:
         print(f"[{site.domain}] verifying task {self.name}...")
+        site.emit("task-started", task=self.name)
 
-        results = [c.validate(site) for c in self.checks]
+        with metrics.task_duration.time(task=self.name):
+            results = self.run_checks(site)
         print(results)
         if all(c.status == "pass" for c in results):
             status = "pass"
         else:
             status = "fail"
-        return TaskStatus(status, checks=results)
+        metrics.task_results.inc(task=self.name, status=status)
+        task_status = TaskStatus(status, checks=results)
+        site.emit("task", task=self.name, status=asdict(task_status))
+        return task_status
+
+    def run_checks(self, site):
+        """Runs all the checks of this task and returns their status.
+
+        The independent checks are run in parallel and the sequential
+        checks are run after them, one after the other. An event is emitted
+        for every check as soon as it is completed.
+        """
+        def validate(check):
+            status = check.validate(site)
+            site.emit("check", task=self.name, check=asdict(status))
+            return status
+
+        parallel_checks = [c for c in self.checks if not c.sequential]
+        if config.CHECK_CONCURRENCY <= 1 or len(parallel_checks) <= 1:
+            return [validate(c) for c in self.checks]
+
+        max_workers = min(config.CHECK_CONCURRENCY, len(parallel_checks))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {c: executor.submit(validate, c) for c in parallel_checks}
+
+        return [futures[c].result() if c in futures else validate(c)
+                for c in self.checks]
 
     @classmethod
     def load_from_file(cls, filename) -> List[Task]:
         """Loads a list of tasks from a file.
         """
+        import yaml
+
         data = yaml.safe_load_all(open(filename))
         return [cls.from_dict(d) for d in data]
 
@@ -498,10 +887,12 @@ class Task:
         else:
             raise ValueError(f"Invalid check: {check_data}")
 
-TASKS = Task.load_from_file("tasks.yml")
+TASKS = Catalog("tasks.yml")
 
-def get_last_email():
-    """Returns an email.message.Message instance
+def wait_for_email(recipient, since, timeout):
+    """Waits for an email to the recipient that is received after the
+    since timestamp and returns it as an email.message.Message instance.
+    Returns None if no such email is received in timeout seconds.
 
     It can be used like this:
     ```
@@ -513,12 +904,9 @@ def get_last_email():
     body = msg.get_payload()
     ```
     """
-    if not Path(MAIL_FILE).exists():
-        return None
+    from catcher import Mailbox
 
-    p = EmailParser()
-    with open(MAIL_FILE) as f:
-        return p.parse(f)
+    return Mailbox(config.MAIL_DB).wait_for(recipient, since=since, timeout=timeout)
 
 def main():
     import sys, json
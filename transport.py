@@ -0,0 +1,134 @@
+"""HTTP transport for the requests made to the participants' sites.
+
+All the requests to a site go through a session shared by all the Site
+objects of that domain, so that the connections are kept alive and
+reused across the checks and the verifications.
+
+Each domain also has a circuit breaker, which stops the requests to a
+site for a while after it has failed to respond a few times in a row.
+"""
+import threading
+import time
+
+import config
+
+# requests is imported only when a session is created, as this module is
+# imported by the read-only pages of the app as well.
+
+TIMEOUT = (config.HTTP_CONNECT_TIMEOUT, config.HTTP_READ_TIMEOUT)
+
+# only the idempotent requests are retried on connection errors and on
+# the errors from the proxy in front of the site
+RETRY_METHODS = ["GET", "HEAD"]
+RETRY_STATUSES = [502, 503, 504]
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class SiteUnavailable(Exception):
+    """Raised for the requests to a site while its circuit breaker is
+    open.
+    """
+
+
+class DeadlineExceeded(Exception):
+    """Raised for the requests made after the time for the check or the
+    verification has run out.
+    """
+
+
+def get_backoff(retry):
+    """Returns the seconds to wait before the given retry, counting from 1.
+
+    The first retry is made right away and the wait doubles after that.
+    """
+    if retry < 2:
+        return 0
+    return config.HTTP_BACKOFF * 2 ** (retry - 1)
+
+
+def new_adapter():
+    from requests.adapters import HTTPAdapter
+
+    # the retries are made by Site._request, which knows the time left for
+    # the check, and not by the adapter, which would give every retry the
+    # full timeout
+    return HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=config.HTTP_POOL_SIZE,
+        max_retries=0)
+
+
+def new_session():
+    """Creates a new session with its own cookies.
+    """
+    import requests
+
+    session = requests.Session()
+    adapter = new_adapter()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session(domain):
+    """Returns the session shared by all the requests to the domain.
+
+    The shared session doesn't keep any cookies. Use a new session for
+    the requests that need to maintain the login state.
+    """
+    import http.cookiejar
+
+    with _sessions_lock:
+        if domain not in _sessions:
+            session = new_session()
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            _sessions[domain] = session
+        return _sessions[domain]
+
+
+class CircuitBreaker:
+    """Circuit breaker for the requests to a site.
+
+    The breaker opens after threshold consecutive connection failures and
+    the requests fail fast till cooldown seconds have passed. After that,
+    the requests are let through again. A successful response closes the
+    breaker and another failure opens it right away.
+    """
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Tells if a request can be made to the site.
+        """
+        with self._lock:
+            return self.opened_at is None or time.monotonic() - self.opened_at >= self.cooldown
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.threshold and self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+def get_breaker(domain):
+    """Returns the circuit breaker shared by all the requests to the
+    domain.
+    """
+    with _breakers_lock:
+        if domain not in _breakers:
+            _breakers[domain] = CircuitBreaker(config.BREAKER_THRESHOLD, config.BREAKER_COOLDOWN)
+        return _breakers[domain]
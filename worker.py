@@ -0,0 +1,116 @@
+"""Worker process that runs the verification jobs in the job table.
+
+The app saves the jobs in the job table, unless it is run with
+RAJDHANI_JOB_QUEUE=memory. Any number of workers can be run against the same
+database. A worker holds a lease on the job it is running and renews it
+every few seconds, so that the job of a worker that dies is taken over by
+another one once the lease expires.
+
+The workers must run on the host of the mail catcher (catcher.py). The
+check of the confirmation email reads the mailbox, a sqlite file on that
+host, and compares the time of the booking with the time the catcher
+received the email.
+
+Usage:
+
+    $ python worker.py [-n THREADS]
+"""
+import argparse
+import os
+import socket
+import threading
+import time
+import traceback
+
+import config
+import metrics
+from db import App
+from jobs import DBJob, get_app_status
+
+# seconds to wait before looking for a job again, when there is none
+POLL_INTERVAL = 1
+
+# seconds between the pruning of the old jobs
+PRUNE_INTERVAL = 3600
+
+
+class Worker:
+    def __init__(self, name, lease=config.JOB_LEASE, max_attempts=config.JOB_MAX_ATTEMPTS):
+        self.name = name
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+    def run_forever(self):
+        while True:
+            job = DBJob.claim(self.name, self.lease)
+            if job:
+                self.run(job)
+            else:
+                time.sleep(POLL_INTERVAL)
+
+    def run(self, job):
+        print(f"[{self.name}] running job {job.id} of {job.app_name}, attempt {job.attempts}")
+        if job.attempts > self.max_attempts:
+            job.fail(f"Gave up after {job.attempts - 1} attempts", self.max_attempts)
+            return
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(job, stop), daemon=True)
+        heartbeat.start()
+        try:
+            app = App.find(job.app_name)
+            if not app:
+                job.fail(f"App not found: {job.app_name}", max_attempts=0)
+                return
+            status = get_app_status(app, full=job.full, on_event=job.add_event)
+            if not job.finish(app, status):
+                print(f"[{self.name}] job {job.id} was taken over by another worker, discarded the result")
+        except Exception as e:
+            traceback.print_exc()
+            job.fail(str(e), self.max_attempts)
+        finally:
+            stop.set()
+            heartbeat.join()
+
+    def heartbeat(self, job, stop):
+        """Renews the lease on the job till stop is set.
+        """
+        while not stop.wait(self.lease / 3):
+            if not job.renew(self.lease):
+                print(f"[{self.name}] lost the lease on job {job.id}")
+                return
+
+
+def main():
+    p = argparse.ArgumentParser(description="Run the verification jobs in the job table")
+    p.add_argument("-n", "--threads", type=int, default=config.WORKERS,
+                   help=f"number of jobs to run at the same time (default: {config.WORKERS})")
+    p.add_argument("--metrics-port", type=int, default=config.WORKER_METRICS_PORT,
+                   help="port to export the metrics at, 0 to not export them"
+                        f" (default: {config.WORKER_METRICS_PORT})")
+    args = p.parse_args()
+
+    # the checks run in this process, so their metrics are exported here
+    # and not by the /metrics of the app
+    if args.metrics_port:
+        try:
+            metrics.serve(args.metrics_port)
+            print(f"Exporting the metrics at http://localhost:{args.metrics_port}/metrics")
+        except OSError as e:
+            print(f"Failed to export the metrics at port {args.metrics_port}: {e}")
+
+    prefix = f"{socket.gethostname()}:{os.getpid()}"
+    for i in range(args.threads):
+        worker = Worker(f"{prefix}:{i}")
+        threading.Thread(target=worker.run_forever, name=f"worker-{i}", daemon=True).start()
+
+    try:
+        while True:
+            DBJob.prune(config.JOB_RETENTION_DAYS)
+            time.sleep(PRUNE_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
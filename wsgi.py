@@ -5,4 +5,12 @@ For Hamr
 import sys
 sys.stdout = sys.stderr
 
+import config
+
+# the process exits after the request, so the jobs kept in memory would
+# never run
+if config.JOB_QUEUE == "memory":
+    raise RuntimeError("RAJDHANI_JOB_QUEUE=memory needs a long running process, "
+                       "use the db queue and run the jobs with worker.py")
+
 from app import app